@@ -0,0 +1,117 @@
+''' Helpers shared by the benchmarks.
+
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import json
+import os
+import os.path
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+'''Repository root'''
+
+
+def make_workdir(prefix):
+    return tempfile.mkdtemp(prefix='consys-{0}-'.format(prefix))
+
+def remove_workdir(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+def generate_key(path):
+    ''' Generates an RSA key pair at path and path.pub. '''
+    subprocess.check_call(['ssh-keygen', '-q', '-t', 'rsa', '-b', '2048',
+                           '-m', 'PEM', '-N', '', '-C', 'consys-benchmark',
+                           '-f', path])
+
+def create_database(path):
+    ''' Creates an empty server database from server.sql. '''
+    with open(os.path.join(ROOT, 'server.sql')) as f:
+        schema = f.read()
+    connection = sqlite3.connect(path)
+    try:
+        connection.executescript(schema)
+        connection.commit()
+    finally:
+        connection.close()
+
+def write_config(path, root=None, sections=None):
+    ''' Writes a configuration file.
+    @type root: dict of root section values
+    @type sections: dict of section name -> dict of values
+    '''
+    with open(path, 'w') as f:
+        for key, value in sorted((root or {}).items()):
+            print('{0} = {1}'.format(key, value), file=f)
+        for name, values in sorted((sections or {}).items()):
+            print('[{0}]'.format(name), file=f)
+            for key, value in sorted(values.items()):
+                print('{0} = {1}'.format(key, value), file=f)
+
+def use_config(path):
+    ''' Makes consys.common.configuration (imported later) read the given
+    configuration file in non-daemon mode. '''
+    sys.argv = sys.argv[:1] + ['-f', '-c', path]
+
+def free_port():
+    ''' Returns a loopback TCP port which is free at the moment. '''
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def wait_for_port(port, timeout):
+    ''' Waits until something listens on the loopback port. '''
+    deadline = time.time() + timeout
+    while True:
+        s = socket.socket()
+        try:
+            s.connect(('127.0.0.1', port))
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+        finally:
+            s.close()
+
+def percentile(values, p):
+    ''' Nearest-rank percentile of a sorted list. '''
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'min': values[0],
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1],
+    }
+
+def dump_results(results, path):
+    ''' Writes machine-readable results to path, '-' meaning stdout. '''
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if path == '-':
+        print(text)
+    elif path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,270 @@
+#!/usr/bin/env python2
+''' Loopback login throughput benchmark.
+
+Starts a ConSys server on a loopback port with a temporary SQLite database
+and freshly generated keys, then drives headless fake terminals through
+the real client login path (ClientTransport -> SimplePubkeyUserAuth ->
+RpcChannel -> set_mind -> get_terminal_id/set_terminal_id). Reports
+time-to-online percentiles and connections per second.
+
+Example:
+    benchmarks/login_throughput.py -n 500 --json results.json
+
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import argparse
+import functools
+import os.path
+import signal
+import subprocess
+import sys
+import time
+
+import benchutil
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--clients', type=int, default=200,
+                        help='number of fake terminals (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='connection attempts per second, 0 to start all '
+                             'at once (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds to wait for all terminals to come '
+                             'online (default: %(default)s)')
+    parser.add_argument('--max-handshakes', type=int, default=None,
+                        help='server admission limit (default: server '
+                             'default)')
+    parser.add_argument('--json', default=None, metavar='PATH',
+                        help='write machine-readable results to PATH, '
+                             '- for stdout')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary directory with server logs')
+    return parser.parse_args()
+
+
+def prepare(workdir, port, args):
+    ''' Creates keys, database and configuration files. '''
+    path = functools.partial(os.path.join, workdir)
+    benchutil.generate_key(path('server'))
+    benchutil.generate_key(path('client'))
+    benchutil.create_database(path('server.db'))
+    open(path('admins.txt'), 'w').close()
+    server_sections = {
+        'network': {
+            'listen-string': 'tcp:{0}:interface=127.0.0.1'.format(port),
+            'server-key': path('server'),
+            'client-public-key': path('client.pub'),
+            'user-auth-db': path('admins.txt'),
+        },
+        'server-persistence': {
+            'db-url': 'sqlite:///' + path('server.db'),
+        },
+        'log': {
+            'logdir': workdir,
+        },
+    }
+    if args.max_handshakes is not None:
+        server_sections['admission'] = {
+            'max-handshakes': args.max_handshakes,
+        }
+    benchutil.write_config(path('server.conf'),
+                           {'server-pid-file': path('server.pid')},
+                           server_sections)
+    benchutil.write_config(path('client.conf'),
+                           {'client-pid-file': path('client.pid')},
+                           {'network': {
+                               'server-string': 'tcp:127.0.0.1:{0}'.format(port),
+                               'client-key': path('client'),
+                               'server-public-key': path('server.pub'),
+                            },
+                            'client-persistence': {
+                               'db-file': path('client.db'),
+                            }})
+
+
+def start_server(workdir):
+    return subprocess.Popen([sys.executable,
+                             os.path.join(benchutil.ROOT, 'consys-start.py'),
+                             'server', '-f', '-c',
+                             os.path.join(workdir, 'server.conf')],
+                            cwd=benchutil.ROOT)
+
+
+def run_clients(args, workdir):
+    ''' Drives the fake terminals, returns the list of FakeTerminals. '''
+    benchutil.use_config(os.path.join(workdir, 'client.conf'))
+    from twisted.internet import reactor, protocol, endpoints, defer
+    from twisted.spread import pb
+    from consys.common import configuration, keycache
+    from consys.client import network
+
+    config = configuration.get_config('network')
+
+    class HeadlessMind(pb.Referenceable):
+        ''' Client RPC root without any desktop integration. '''
+        def __init__(self, terminal):
+            self.terminal = terminal
+            self.terminal_id = None
+
+        def remote_get_terminal_id(self):
+            self.terminal.mark('asked')
+            if self.terminal_id is not None:
+                self.terminal.mark('online')
+            return self.terminal_id
+
+        def remote_set_terminal_id(self, id):
+            self.terminal_id = id
+            self.terminal.mark('online')
+
+        def remote_ping(self):
+            pass
+
+    class HeadlessConnection(network.SSHConnection):
+        def __init__(self, terminal, deferred, onDisconnect):
+            network.SSHConnection.__init__(self, deferred, onDisconnect)
+            self.terminal = terminal
+
+        def serviceStarted(self):
+            self.terminal.mark('authenticated')
+            network.SSHConnection.serviceStarted(self)
+
+        def makeMind(self):
+            return HeadlessMind(self.terminal)
+
+    class FakeTerminal(object):
+        def __init__(self, index):
+            self.index = index
+            self.started = None
+            self.times = {}
+            self.connection = None
+            self.error = None
+            self.online = defer.Deferred()
+
+        def mark(self, event):
+            if event not in self.times:
+                self.times[event] = time.time() - self.started
+            if event == 'online' and not self.online.called:
+                self.online.callback(self)
+
+        def start(self):
+            self.started = time.time()
+            deferred = defer.Deferred()
+            factory = protocol.Factory()
+            factory.protocol = lambda: network.ClientTransport(
+                keycache.get_key(config['server-public-key']),
+                deferred, self.on_disconnect,
+                functools.partial(HeadlessConnection, self))
+            endpoint = endpoints.clientFromString(
+                reactor, config['server-string'].encode('utf-8'))
+            endpoint.connect(factory).addErrback(deferred.errback)
+            deferred.addCallbacks(self.on_connected, self.on_error)
+
+        def on_connected(self, connection):
+            self.connection = connection
+            self.mark('rpc-ready')
+
+        def on_error(self, failure):
+            self.error = failure.getErrorMessage()
+            if not self.online.called:
+                self.online.callback(self)
+
+        def on_disconnect(self):
+            if not self.online.called:
+                self.error = 'disconnected before coming online'
+                self.online.callback(self)
+
+    terminals = [FakeTerminal(i) for i in range(args.clients)]
+    started = time.time()
+    for terminal in terminals:
+        delay = terminal.index / args.rate if args.rate > 0 else 0
+        reactor.callLater(delay, terminal.start)
+
+    def _cbDone(_):
+        for terminal in terminals:
+            if terminal.connection is not None:
+                terminal.connection.transport.loseConnection()
+        reactor.callLater(0.5, reactor.stop)
+    def _cbTimeout():
+        for terminal in terminals:
+            if not terminal.online.called:
+                terminal.error = 'timed out'
+                terminal.online.callback(terminal)
+    timer = reactor.callLater(args.timeout, _cbTimeout)
+    done = defer.DeferredList([t.online for t in terminals])
+    done.addCallback(lambda _: timer.active() and timer.cancel())
+    done.addCallback(_cbDone)
+    reactor.run()
+    return started, terminals
+
+
+def report(args, started, terminals):
+    online = [t for t in terminals if 'online' in t.times]
+    failed = [t for t in terminals if 'online' not in t.times]
+    elapsed = max([t.started + t.times['online'] for t in online]
+                  or [started]) - started
+    errors = {}
+    for t in failed:
+        errors[t.error] = errors.get(t.error, 0) + 1
+    results = {
+        'clients': args.clients,
+        'rate': args.rate,
+        'online': len(online),
+        'failed': len(failed),
+        'errors': errors,
+        'elapsed': elapsed,
+        'connections-per-second': len(online) / elapsed if elapsed else None,
+    }
+    for event in ('authenticated', 'rpc-ready', 'online'):
+        results['time-to-' + event] = benchutil.summarize(
+            [t.times[event] for t in terminals if event in t.times])
+    return results
+
+
+def print_summary(results):
+    print('Terminals online: {0}/{1}, failed: {2}'.format(
+        results['online'], results['clients'], results['failed']))
+    for error, count in sorted(results['errors'].items()):
+        print('  {0}: {1}'.format(error, count))
+    if results['connections-per-second'] is not None:
+        print('Throughput: {0:.1f} connections/s over {1:.2f} s'.format(
+            results['connections-per-second'], results['elapsed']))
+    for event in ('authenticated', 'rpc-ready', 'online'):
+        stats = results['time-to-' + event]
+        if stats:
+            print('Time to {0}: p50 {1:.3f} s, p95 {2:.3f} s, '
+                  'p99 {3:.3f} s, max {4:.3f} s'.format(
+                      event, stats['p50'], stats['p95'], stats['p99'],
+                      stats['max']))
+
+
+def main():
+    args = parse_args()
+    workdir = benchutil.make_workdir('login')
+    server = None
+    try:
+        port = benchutil.free_port()
+        prepare(workdir, port, args)
+        server = start_server(workdir)
+        benchutil.wait_for_port(port, 30)
+        started, terminals = run_clients(args, workdir)
+        results = report(args, started, terminals)
+        print_summary(results)
+        benchutil.dump_results(results, args.json)
+    finally:
+        if server is not None and server.poll() is None:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        if args.keep:
+            print('Server logs are kept in {0}'.format(workdir))
+        else:
+            benchutil.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
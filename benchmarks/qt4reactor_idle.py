@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+''' Idle wakeup benchmark for the Qt reactor.
+
+Runs QTReactor with no network activity for a fixed period and counts how
+many times its timer fires and how many times reactorInvokePrivate runs.
+With --interval a LoopingCall is scheduled, standing for the periodic
+work of the admin console. An idle reactor should only wake up for its
+delayed calls: the excess wakeups reported are those not explained by a
+scheduled call (the old reactor polled ten times a second).
+
+Example:
+    benchmarks/qt4reactor_idle.py --seconds 30 --interval 5
+
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import argparse
+import time
+
+import benchutil
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='how long to run idle (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='period of a LoopingCall to run meanwhile, 0 for '
+                             'none (default: %(default)s)')
+    parser.add_argument('--json', default=None, metavar='PATH',
+                        help='write machine-readable results to PATH, '
+                             '- for stdout')
+    return parser.parse_args()
+
+
+def run(args):
+    ''' Runs the reactor, returns the counts. '''
+    from PyQt4.QtCore import QCoreApplication, QObject, SIGNAL
+    application = QCoreApplication([])
+    from consys.common import qt4reactor
+    qt4reactor.install()
+    from twisted.internet import reactor, task
+
+    counts = {'timer-fires': 0, 'invocations': 0, 'delayed-calls': 0}
+
+    def _count_fire():
+        counts['timer-fires'] += 1
+    QObject.connect(reactor._timer, SIGNAL('timeout()'), _count_fire)
+
+    # Replaced before run() connects the timer to it
+    invoke = reactor.reactorInvokePrivate
+    def _counting_invoke():
+        counts['invocations'] += 1
+        invoke()
+    reactor.reactorInvokePrivate = _counting_invoke
+
+    def _tick():
+        counts['delayed-calls'] += 1
+    if args.interval > 0:
+        task.LoopingCall(_tick).start(args.interval, now=False)
+    reactor.callLater(args.seconds, reactor.stop)
+
+    started = time.time()
+    reactor.run()
+    counts['seconds'] = time.time() - started
+    del application
+    return counts
+
+
+def report(args, counts):
+    # One wakeup to start, one per delayed call and one to stop
+    expected = counts['delayed-calls'] + 2
+    return {
+        'seconds': counts['seconds'],
+        'interval': args.interval,
+        'timer-fires': counts['timer-fires'],
+        'invocations': counts['invocations'],
+        'delayed-calls': counts['delayed-calls'],
+        'excess-wakeups': max(counts['invocations'] - expected, 0),
+        'wakeups-per-second': counts['invocations'] / counts['seconds'],
+    }
+
+
+def print_summary(results):
+    print('Ran idle for {0:.1f}s'.format(results['seconds']))
+    print('  timer fires:      {0}'.format(results['timer-fires']))
+    print('  invocations:      {0} ({1:.2f}/s)'.format(
+        results['invocations'], results['wakeups-per-second']))
+    print('  delayed calls:    {0}'.format(results['delayed-calls']))
+    print('  excess wakeups:   {0}'.format(results['excess-wakeups']))
+
+
+def main():
+    args = parse_args()
+    results = report(args, run(args))
+    print_summary(results)
+    benchutil.dump_results(results, args.json)
+
+
+if __name__ == '__main__':
+    main()
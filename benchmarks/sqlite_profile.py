@@ -0,0 +1,167 @@
+#!/usr/bin/env python2
+''' SQLite profile benchmark for the server database.
+
+Runs the server persistence layer against a fresh database once per
+SQLite profile (each in its own process, as the configuration is read at
+import time) and measures inserting, updating, loading and looking up
+terminals by id.
+
+Example:
+    benchmarks/sqlite_profile.py -n 10000 --json results.json
+
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import argparse
+import json
+import os.path
+import subprocess
+import sys
+import time
+
+import benchutil
+
+PROFILES = {
+    # What the server used before the profile became configurable
+    'legacy': {
+        'journal-mode': 'delete',
+        'synchronous': 'full',
+        'cache-size': -2000,
+        'mmap-size': 0,
+        'pool-size': 5,
+        'statement-cache': 100,
+    },
+    # Server defaults
+    'tuned': {},
+}
+
+OPERATIONS = ('insert', 'update', 'load', 'find')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--terminals', type=int, default=10000,
+                        help='number of terminals (default: %(default)s)')
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES),
+                        help='profile to run, may be repeated (default: all)')
+    parser.add_argument('--flush-size', type=int, default=None,
+                        help='write-behind flush size (default: server '
+                             'default)')
+    parser.add_argument('--json', default=None, metavar='PATH',
+                        help='write machine-readable results to PATH, '
+                             '- for stdout')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary directory with the databases')
+    parser.add_argument('--worker', default=None, metavar='CONFIG',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def run_worker(args):
+    ''' Runs all operations in this process, prints results as JSON. '''
+    benchutil.use_config(args.worker)
+    from twisted.internet import reactor, defer
+    from twistar.registry import Registry
+    from consys.common import app
+    from consys.server import persistent
+
+    class Terminal(persistent.Base):
+        TABLENAME = 'terminals'
+
+    persistent.register_classes(Terminal)
+    results = {}
+
+    @defer.inlineCallbacks
+    def run():
+        n = args.terminals
+        started = time.time()
+        terminals = [Terminal(name='PC') for _ in range(n)]
+        yield defer.gatherResults([t.save() for t in terminals])
+        results['insert'] = time.time() - started
+
+        started = time.time()
+        for terminal in terminals:
+            terminal.name = 'PC#{0}'.format(terminal.id)
+        yield defer.gatherResults([t.save() for t in terminals])
+        results['update'] = time.time() - started
+
+        started = time.time()
+        loaded = yield Terminal.all()
+        results['load'] = time.time() - started
+        assert len(loaded) == n
+
+        started = time.time()
+        yield defer.gatherResults([Terminal.find(t.id) for t in terminals])
+        results['find'] = time.time() - started
+
+    def _ebRun(failure):
+        results['error'] = failure.getErrorMessage()
+    def _cbStop(_):
+        Registry.DBPOOL.close()
+        reactor.stop()
+
+    app.startup()
+    reactor.callWhenRunning(
+        lambda: run().addErrback(_ebRun).addBoth(_cbStop))
+    reactor.run()
+    json.dump(results, sys.stdout)
+
+
+def run_profile(workdir, name, args):
+    path = os.path.join(workdir, name)
+    benchutil.create_database(path + '.db')
+    section = {'db-url': 'sqlite:///' + path + '.db'}
+    section.update(PROFILES[name])
+    if args.flush_size is not None:
+        section['flush-size'] = args.flush_size
+    benchutil.write_config(path + '.conf', {},
+                           {'server-persistence': section})
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '-n', str(args.terminals),
+                                      '--worker', path + '.conf'],
+                                     cwd=benchutil.ROOT)
+    times = json.loads(output.decode('utf-8'))
+    if 'error' in times:
+        raise RuntimeError('Profile {0} failed: {1}'.format(name,
+                                                            times['error']))
+    results = {'settings': section}
+    for operation in OPERATIONS:
+        results[operation] = {
+            'seconds': times[operation],
+            'terminals-per-second': args.terminals / times[operation],
+        }
+    return results
+
+
+def print_summary(results):
+    print('{0:<10}'.format('profile') +
+          ''.join('{0:>14}'.format(op + '/s') for op in OPERATIONS))
+    for name, result in sorted(results['profiles'].items()):
+        print('{0:<10}'.format(name) +
+              ''.join('{0:>14.0f}'.format(result[op]['terminals-per-second'])
+                      for op in OPERATIONS))
+
+
+def main():
+    args = parse_args()
+    if args.worker is not None:
+        return run_worker(args)
+    workdir = benchutil.make_workdir('sqlite')
+    try:
+        results = {'terminals': args.terminals, 'profiles': {}}
+        for name in args.profile or sorted(PROFILES):
+            results['profiles'][name] = run_profile(workdir, name, args)
+        print_summary(results)
+        benchutil.dump_results(results, args.json)
+    finally:
+        if args.keep:
+            print('Databases are kept in {0}'.format(workdir))
+        else:
+            benchutil.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
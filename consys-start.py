@@ -26,6 +26,10 @@ if __name__ == '__main__':
             sys.argv[0] += ' ' + action
             sys.argv = sys.argv[0:1] + sys.argv[2:]
     
+    if '--profile-startup' in sys.argv:
+        from consys.common import profiling
+        profiling.enable()
+
     try:
         # FIXME when migrating to Python 3!
         a = __import__('consys.' + action, fromlist=[b'run'])
@@ -7,6 +7,7 @@ from PyQt4 import QtCore, QtGui
 
 from consys.common import log
 from consys.common import configuration
+from consys.common import profiling
 
 _log = log.getLogger(__name__)
 
@@ -18,12 +19,17 @@ def run():
         _log.info('Initializing ConSys admin...')
         global qtapp
         qtapp = QtGui.QApplication(sys.argv)
-        from consys.common import qt4reactor
-        qt4reactor.install()
+        from consys.admin import bridge
+        bridge.install()
         from consys.common import app
-        from consys.admin import login, ampclient, main
-        app.startup()
-        app.dispatch_loop()
+        profiling.import_modules('consys.common', ['lag'])
+        profiling.import_modules('consys.admin', ['login', 'ampclient', 'main'])
+        # Every section is registered by now, validate them together
+        configuration.validate()
+        with profiling.timed('app.startup'):
+            app.startup()
+        profiling.report()
+        bridge.dispatch_loop()
         _log.info('Terminating ConSys admin...')
     except Exception:
         _log.exception('Unhandled exception in main thread, exiting')
@@ -10,37 +10,37 @@ from twisted.protocols import amp
 
 from consys.common.ampi import admin
 from consys.common import network, log
-from consys.admin import login
+from consys.admin import login, bridge, network as admin_network
 
 _log = log.getLogger(__name__)
 
 class AmpClientProtocol(amp.AMP):
-    
+
     @admin.Ping.responder
     def on_ping(self):
         return {}
     
-    @admin.NewTerminal.responder
-    def on_new_terminal(self, id):
-        new_terminal(id)
-        return {}
-
-    @admin.RemovedTerminal.responder
-    def on_removed_terminal(self, id):
-        terminal_removed(id)
-        return {}
-
-    @admin.TerminalStatusUpdated.responder
-    def on_terminal_status_updated(self, id, online):
-        terminal_status_updated(id, online)
+    @admin.TerminalEventsBatch.responder
+    def on_terminal_events_batch(self, seq, events):
+        terminal_events(seq, events)
         return {}
 
 _factory = protocol.Factory() 
 _factory.protocol = AmpClientProtocol
     
 def on_login():
+    global _logged_in
+    _logged_in = True
+    open_channel(login.connection)
+
+def on_reconnect(connection):
+    if _logged_in:
+        _log.info('Reopening AMP channel after reconnect')
+        open_channel(connection)
+
+def open_channel(connection):
     channel = network.AmpChannel(factory=_factory)
-    login.connection.openChannel(channel)
+    connection.openChannel(channel)
     def _cbChannel(ch):
         global protocol
         protocol = ch.protocol
@@ -54,24 +54,17 @@ ready = Signal()
 @param protocol: The AMP protocol instance
 @type protocol: AmpClientProtocol
 '''
-new_terminal = Signal()
-'''Is called when a new terminal is added.
-@param id: New terminal id
-@type id: int
-'''
-terminal_removed = Signal()
-'''Is called when a terminal is removed.
-@param id: Removed terminal id
-@type id: int
-'''
-terminal_status_updated = Signal()
-'''Is called when a terminal has come online/offline.
-@param id: Updated terminal id
-@type id: int
-@param online: True if the terminal is online now
-@type online: bool
+terminal_events = Signal()
+'''Is called when a batch of terminal events arrives.
+@param seq: Batch sequence number
+@type seq: int
+@param events: Events in the order they have happened, see
+    admin.TerminalEventsBatch
+@type events: list of dicts
 '''
 
 protocol = None
+_logged_in = False
 
-login.successful.connect(on_login)
+login.successful.connect(bridge.on_reactor(on_login))
+admin_network.connected.connect(on_reconnect)
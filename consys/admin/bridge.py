@@ -0,0 +1,139 @@
+'''
+Bridge between the Qt GUI and Twisted. By default Twisted runs inside the
+Qt main loop (qt4reactor) and the bridge calls everything directly. In
+threaded mode Twisted runs its native reactor in a background thread:
+GUI code hands work to the reactor with callFromThread, and reactor code
+hands model and widget updates to the GUI through a queued Qt signal,
+delivered in batches.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import functools
+import threading
+
+from PyQt4 import QtCore
+from twisted.internet import defer
+
+from consys.common import log
+from consys.common import configuration
+
+_config = configuration.register_section(None,
+    {
+        'admin-reactor': 'option(qt4, thread, default=qt4)',
+    })
+
+_log = log.getLogger(__name__)
+
+threaded = False
+'''True if Twisted runs in a background thread, set by install()'''
+
+
+class _GuiDispatcher(QtCore.QObject):
+    '''Runs calls queued from the reactor thread in the GUI thread. One
+    signal is emitted per batch, however many calls it collects.'''
+
+    pending = QtCore.pyqtSignal()
+
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.pending.connect(self.run_pending, QtCore.Qt.QueuedConnection)
+
+    def queue(self, func, args, kwargs):
+        with self.lock:
+            self.calls.append((func, args, kwargs))
+            first = len(self.calls) == 1
+        if first:
+            self.pending.emit()
+
+    def run_pending(self):
+        with self.lock:
+            calls, self.calls = self.calls, []
+        for func, args, kwargs in calls:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                _log.exception('Error in GUI call {0}'.format(func))
+
+_dispatcher = None
+
+
+def install():
+    '''Installs the reactor for the configured mode. Must be called in
+    the GUI thread after QApplication has been created.'''
+    global _dispatcher, threaded
+    threaded = _config['admin-reactor'] == 'thread'
+    if threaded:
+        _dispatcher = _GuiDispatcher()
+        try:
+            from twisted.internet import epollreactor
+            epollreactor.install()
+        except ImportError:
+            _log.info('epoll is not available, using the default reactor')
+        _log.info('Running Twisted in a background thread')
+    else:
+        from consys.common import qt4reactor
+        qt4reactor.install()
+
+def to_gui(func, *args, **kwargs):
+    '''Calls func in the GUI thread.'''
+    if threaded:
+        _dispatcher.queue(func, args, kwargs)
+    else:
+        func(*args, **kwargs)
+
+def to_reactor(func, *args, **kwargs):
+    '''Calls func in the reactor thread.'''
+    if threaded:
+        from twisted.internet import reactor
+        reactor.callFromThread(func, *args, **kwargs)
+    else:
+        func(*args, **kwargs)
+
+def on_gui(func):
+    '''Returns a function calling func in the GUI thread, for connecting
+    GUI handlers to signals emitted in the reactor thread.'''
+    return functools.wraps(func)(functools.partial(to_gui, func))
+
+def on_reactor(func):
+    '''Returns a function calling func in the reactor thread, for
+    connecting network handlers to signals emitted in the GUI thread.'''
+    return functools.wraps(func)(functools.partial(to_reactor, func))
+
+def call(func, *args, **kwargs):
+    '''Calls func in the reactor thread. Returns a Deferred firing with
+    its result in the GUI thread.'''
+    if not threaded:
+        return defer.maybeDeferred(func, *args, **kwargs)
+    d = defer.Deferred()
+    def _run():
+        result = defer.maybeDeferred(func, *args, **kwargs)
+        result.addBoth(lambda value: to_gui(d.callback, value))
+    to_reactor(_run)
+    return d
+
+def stop_reactor():
+    from twisted.internet import reactor
+    to_reactor(reactor.stop)
+
+def dispatch_loop():
+    '''Dispatches messages until program shutdown.'''
+    from consys.common import app
+    if not threaded:
+        app.dispatch_loop()
+        return
+    from twisted.internet import reactor
+    qapp = QtCore.QCoreApplication.instance()
+    reactor.addSystemEventTrigger('before', 'shutdown', app.shutdown)
+    reactor.addSystemEventTrigger('after', 'shutdown', to_gui, qapp.quit)
+    thread = threading.Thread(target=reactor.run, name='reactor',
+                              kwargs={'installSignalHandlers': False})
+    thread.start()
+    qapp.exec_()
+    if thread.is_alive():
+        # The GUI has quit by itself
+        stop_reactor()
+        thread.join()
@@ -3,14 +3,12 @@ Things related to contest hardware representation.
 @author: Nikita Ofitserov
 '''
 
-import functools
-
 from PyQt4 import QtCore
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from consys.common import log
 from consys.common.ampi import admin
-from consys.admin import ampclient
+from consys.admin import ampclient, bridge
 
 _log = log.getLogger(__name__)
 
@@ -27,36 +25,118 @@ class HardwareModel(QtCore.QAbstractTableModel):
     def __init__(self):
         QtCore.QAbstractTableModel.__init__(self)
         self.rows = []
+        self.ids = []
+        self.map = {}
 
     def setData(self, data):
         '''Fills model with specified data.
         @type data: sequence of tuples (id, name, status)
         '''
+        self.beginResetModel()
         self.rows = []
+        self.ids = []
         self.map = {}
         for id, name, status in data:
-            self._insertData(id, name, status)
-        self.reset()
+            self._appendRow(id, name, status)
+        self.endResetModel()
 
-    def _insertData(self, id, name, status):
+    def _appendRow(self, id, name, status):
         self.map[id] = len(self.rows)
+        self.ids.append(id)
         self.rows.append([unicode(name), bool(status)])
 
+    def _appendRows(self, data):
+        if not data:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QtCore.QModelIndex(), first,
+                             first + len(data) - 1)
+        for id, name, status in data:
+            self._appendRow(id, name, status)
+        self.endInsertRows()
+
+    def _rowsChanged(self, rows):
+        '''Notifies views about changed rows, merging adjacent ones.'''
+        last_column = self.COLUMN_COUNT - 1
+        ranges = []
+        for row in sorted(rows):
+            if ranges and ranges[-1][1] == row - 1:
+                ranges[-1][1] = row
+            else:
+                ranges.append([row, row])
+        for first, last in ranges:
+            self.dataChanged.emit(self.index(first, 0),
+                                  self.index(last, last_column))
+
     def insertData(self, id, name, status):
-        self._insertData(id, name, status)
-        self.reset()
+        if id in self.map:
+            row = self.map[id]
+            self.rows[row] = [unicode(name), bool(status)]
+            self._rowsChanged([row])
+        else:
+            self._appendRows([(id, name, status)])
 
     def removeData(self, id):
-        self.rows.pop(self.map[id])
-        del self.map[id]
-        self.reset()
+        row = self.map.pop(id)
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        del self.rows[row]
+        del self.ids[row]
+        for index in xrange(row, len(self.ids)):
+            self.map[self.ids[index]] = index
+        self.endRemoveRows()
 
     def updateStatus(self, id, status):
         _log.debug('Updating status: terminal {0} is '
                    '{1}'.format(id, 'online' if status else 'offline'))
-        index = self.map[id]
-        self.rows[index][1] = status
-        self.reset()
+        row = self.map[id]
+        if self.rows[row][1] != status:
+            self.rows[row][1] = bool(status)
+            self._rowsChanged([row])
+
+    def applyEvents(self, events):
+        '''Applies a batch of terminal events in a single step. Only the
+        rows that have actually changed are reported to the views.
+        @type events: sequence of dicts, see admin.TerminalEventsBatch
+        '''
+        changed = set()
+        added = []
+        added_map = {}
+        for event in events:
+            id = event['id']
+            kind = event['kind']
+            if kind == 'new':
+                name = event['name'].decode('utf-8')
+                status = bool(event['online'])
+                if id in added_map:
+                    added_map[id][1:] = [name, status]
+                elif id in self.map:
+                    row = self.map[id]
+                    self.rows[row] = [name, status]
+                    changed.add(row)
+                else:
+                    added_map[id] = entry = [id, name, status]
+                    added.append(entry)
+            elif kind == 'removed':
+                if id in added_map:
+                    added.remove(added_map.pop(id))
+                elif id in self.map:
+                    # Row numbers are about to shift
+                    self._rowsChanged(changed)
+                    changed = set()
+                    self.removeData(id)
+            elif kind == 'status':
+                status = bool(event['online'])
+                if id in added_map:
+                    added_map[id][2] = status
+                elif id in self.map:
+                    row = self.map[id]
+                    if self.rows[row][1] != status:
+                        self.rows[row][1] = status
+                        changed.add(row)
+            else:
+                _log.warning('Unknown terminal event: {0}'.format(kind))
+        self._rowsChanged(changed)
+        self._appendRows(added)
 
     def rowCount(self, parent):
         return len(self.rows)
@@ -78,29 +158,106 @@ class HardwareModel(QtCore.QAbstractTableModel):
         return QtCore.QVariant(QtCore.QVariant.Invalid)
 
 
-@inlineCallbacks
-def get_terminal_data(id):
-    ans = yield ampclient.protocol.callRemote(admin.GetTerminalData, id=id)
-    returnValue((id, ans['name'].decode('utf-8'), ans['online']))
+class HardwareSync(object):
+    '''
+    Keeps a HardwareModel in sync with the server. The model is filled
+    from a snapshot once, and is then updated from sequenced event
+    batches. After a reconnect or a lost batch only the missed changes
+    are requested, falling back to a snapshot if the server cannot
+    provide them. Runs in the reactor thread, model updates are passed
+    to the GUI thread.
+    '''
+    SNAPSHOT_ATTEMPTS = 3
+
+    def __init__(self, model):
+        self.model = model
+        self.server = None
+        self.epoch = None
+        self.seq = None
+        self.syncing = False
+
+    def on_ready(self, server):
+        self.server = server
+        self.resync()
+
+    def on_events(self, seq, events):
+        if self.syncing or self.seq is None or seq <= self.seq:
+            # Already covered by a snapshot or delta
+            return
+        if seq != self.seq + 1:
+            _log.warning('Event batches {0}..{1} are '
+                         'missing'.format(self.seq + 1, seq - 1))
+            self.resync()
+            return
+        bridge.to_gui(self.model.applyEvents, events)
+        self.seq = seq
+
+    @inlineCallbacks
+    def resync(self):
+        if self.syncing:
+            return
+        self.syncing = True
+        try:
+            if self.seq is None or not (yield self.fetch_changes()):
+                yield self.fetch_snapshot()
+        except Exception:
+            _log.exception('Cannot synchronize hardware state')
+        finally:
+            self.syncing = False
+
+    @inlineCallbacks
+    def fetch_changes(self):
+        _log.debug('Fetching hardware changes since {0}...'.format(self.seq))
+        try:
+            ans = yield self.server.callRemote(admin.GetChangesSince,
+                                               epoch=self.epoch, seq=self.seq)
+        except admin.ChangesUnavailableError:
+            _log.info('Hardware changes are not available, '
+                      'fetching everything')
+            returnValue(False)
+        _log.debug('Got {0} changes'.format(len(ans['events'])))
+        bridge.to_gui(self.model.applyEvents, ans['events'])
+        self.seq = ans['seq']
+        returnValue(True)
 
-def connect_model(model):
-    ampclient.ready.connect(functools.partial(fetch_hardware, model=model))
     @inlineCallbacks
-    def new_terminal(id):
-        data = yield get_terminal_data(id)
-        model.insertData(*data)
-    ampclient.new_terminal.connect(new_terminal)
-    ampclient.terminal_removed.connect(model.removeData)
-    ampclient.terminal_status_updated.connect(model.updateStatus)
-
-@inlineCallbacks
-def fetch_hardware(server, model):
-    _log.debug('Fetching hardware...')
-    ans = yield server.callRemote(admin.GetTerminals)
-    terminalIds = ans['ids']
-    terminals = []
-    for id in terminalIds:
-        data = yield get_terminal_data(id)
-        terminals.append(data)
-    _log.debug('Terminals: {0}'.format(terminals))
-    model.setData(terminals)
+    def fetch_snapshot(self):
+        '''Fetches all terminals page by page. Later pages are taken after
+        the first one, so the changes since the first page are fetched
+        afterwards.'''
+        for attempt in range(self.SNAPSHOT_ATTEMPTS):
+            _log.debug('Fetching hardware...')
+            terminals = []
+            pages = 0
+            after = None
+            while True:
+                ans = yield self.server.callRemote(admin.GetTerminalsSnapshot,
+                                                   after=after)
+                if after is None:
+                    epoch, seq = ans['epoch'], ans['seq']
+                pages += 1
+                terminals.extend((t['id'], t['name'].decode('utf-8'),
+                                  t['online']) for t in ans['terminals'])
+                if not ans['more']:
+                    break
+                after = ans['terminals'][-1]['id']
+            _log.debug('Got {0} terminals in {1} pages'.format(len(terminals),
+                                                               pages))
+            bridge.to_gui(self.model.setData, terminals)
+            self.epoch = epoch
+            self.seq = seq
+            if pages == 1 or (yield self.fetch_changes()):
+                return
+            _log.info('Hardware has changed too much while fetching, '
+                      'fetching again')
+        _log.warning('Hardware may be out of date until the next change')
+
+
+def connect_model(model):
+    '''Connects the model to the server events.
+    @return: the HardwareSync instance, keep a reference to it
+    '''
+    sync = HardwareSync(model)
+    ampclient.ready.connect(sync.on_ready)
+    ampclient.terminal_events.connect(sync.on_events)
+    return sync
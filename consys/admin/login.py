@@ -11,7 +11,7 @@ from twisted.conch import error
 from consys.common import log
 from consys.common import app
 from consys.admin.login_ui import Ui_LoginDialog
-from consys.admin import network
+from consys.admin import network, bridge
 
 _log = log.getLogger(__name__)
 
@@ -26,7 +26,7 @@ class LoginHandler(object):
         self.do_connect(credentials)
 
     def do_connect(self, credentials):
-        d = network.do_connect(credentials)
+        d = bridge.call(network.do_connect, credentials)
         def _ebConnectionFailed(failure):
             if failure.check(error.UnauthorizedLogin):
                 self.ui.editPassword.selectAll()
@@ -64,7 +64,7 @@ class LoginHandler(object):
         successful()
     
     def on_cancelled(self):
-        app.reactor.stop()
+        bridge.stop_reactor()
     
     def on_startup(self):
         self.dialog = QtGui.QDialog()
@@ -5,9 +5,7 @@ Main admin window.
 
 from PyQt4 import QtGui
 
-from twisted.internet import reactor
-
-from consys.admin import login, hwview
+from consys.admin import login, hwview, bridge
 from consys.admin.main_ui import Ui_MainWindow
 
 class MainWindow(QtGui.QMainWindow):
@@ -17,11 +15,11 @@ class MainWindow(QtGui.QMainWindow):
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
         self.hwmodel = hwview.HardwareModel()
-        hwview.connect_model(self.hwmodel)
+        self.hwsync = hwview.connect_model(self.hwmodel)
         self.ui.terminalsView.setModel(self.hwmodel)
 
     def closeEvent(self, *args, **kwargs):
-        reactor.stop()
+        bridge.stop_reactor()
 
 def on_login():
     global _window
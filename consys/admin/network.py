@@ -5,19 +5,21 @@
 
 from __future__ import unicode_literals 
 
+from notify.all import Signal
 from twisted.conch import error
-from twisted.conch.ssh import userauth, connection, keys
+from twisted.conch.ssh import userauth, connection
 from twisted.internet import defer, protocol
 
-from consys.common import log, network
+from consys.common import log, network, keycache
 from consys.common import configuration, app
 
 
-_config = configuration.register_section('network', 
-    {
+_spec = {
         'server-string': 'string()',
         'server-public-key': 'path(default=keys/server.pub)',
-    })
+    }
+_spec.update(network.BACKOFF_SPEC)
+_config = configuration.register_section('network', _spec)
 
 _log = log.getLogger(__name__)
 
@@ -68,6 +70,7 @@ class SSHConnection(connection.SSHConnection):
     def serviceStarted(self):
         connection.SSHConnection.serviceStarted(self)
         _log.info('Authentication successful')
+        connected(self)
         self.deferred.callback(self)
 
     def serviceStopped(self):
@@ -80,17 +83,15 @@ def _cbConnectionLost():
 
 _credentials = None
 _client_factory = protocol.Factory()
-_client_factory.protocol = lambda: ClientTransport(_server_public_key, 
-                                                   autoConnection.deferred,
-                                                   _cbConnectionLost,
-                                                   _credentials)
-
-_server_public_key = keys.Key.fromFile(_config['server-public-key'])
+_client_factory.protocol = lambda: ClientTransport(
+    keycache.get_key(_config['server-public-key']),
+    autoConnection.deferred, _cbConnectionLost, _credentials)
 
 autoConnection = network.ConnectionAutomaton(_client_factory)
 
 def do_connect(credentials):
     autoConnection.event('disconnect')
+    autoConnection.configure(_config)
     autoConnection.server_string = _config['server-string']
     global _credentials
     _credentials = credentials
@@ -105,4 +106,19 @@ def do_connect(credentials):
 def on_shutdown():
     autoConnection.event('disconnect')
 
+def on_reload(changes):
+    if any(key in network.BACKOFF_SPEC for key in changes):
+        autoConnection.configure(_config)
+    if 'server-string' in changes:
+        # Used from the next connection attempt on
+        autoConnection.server_string = _config['server-string']
+
 app.shutdown.connect(on_shutdown)
+configuration.register_reload_handler(on_reload, 'network')
+
+connected = Signal()
+'''Is emitted every time an SSH connection to the server is established,
+including automatic reconnects.
+@param connection: The established connection
+@type connection: SSHConnection
+'''
@@ -5,6 +5,7 @@ import signal
 from consys.common import log
 from consys.common import configuration
 from consys.common import daemonise
+from consys.common import profiling
 
 _log = log.getLogger(__name__)
 
@@ -33,8 +34,13 @@ def run():
             from twisted.internet import glib2reactor
             glib2reactor.install()
             from consys.common import app
-            from consys.client import network, persistent
-            app.startup()
+            profiling.import_modules('consys.common', ['lag'])
+            profiling.import_modules('consys.client', ['network', 'persistent'])
+            # Every section is registered by now, validate them together
+            configuration.validate()
+            with profiling.timed('app.startup'):
+                app.startup()
+            profiling.report()
             app.dispatch_loop()
             _log.info('Terminating ConSys client daemon...')
     except Exception:
@@ -22,8 +22,15 @@ class Locker(pb.Referenceable):
     plasma_overlay_path = (b'org.kde.plasma-overlay', b'/App')
     
     def __init__(self):
-        object = dbus.session_bus().get_object(*self.screensaver_path)
-        self.screensaver = object.get_interface(b'org.freedesktop.ScreenSaver')
+        self._screensaver = None
+
+    @property
+    def screensaver(self):
+        if self._screensaver is None:
+            object = dbus.session_bus().get_object(*self.screensaver_path)
+            self._screensaver = object.get_interface(
+                b'org.freedesktop.ScreenSaver')
+        return self._screensaver
         
     def lock(self):
         d = self.screensaver.call(b'Lock')
@@ -31,6 +38,7 @@ class Locker(pb.Referenceable):
             _log.debug('Screen locked')
         def errback(failure):
             _log.error('Failed to lock screen: {0}'.format(failure))
+            return failure
         return d.addCallbacks(callback, errback)
     
     def unlock(self):
@@ -47,6 +55,7 @@ class Locker(pb.Referenceable):
             _log.debug('Screen unlocked')
         def errback(failure):
             _log.error('Failed to unlock screen: {0}'.format(failure))
+            return failure
         return d.addCallbacks(callback, errback)
     
     def remote_lock(self):
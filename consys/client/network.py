@@ -7,29 +7,32 @@ from __future__ import unicode_literals
 
 import os
 
-from twisted.conch.ssh import userauth, connection, keys
+from twisted.conch.ssh import userauth, connection
 from twisted.internet import defer, protocol
 from twisted.spread import pb
 
 from consys.common import log
 from consys.common import configuration, app
-from consys.common import network
+from consys.common import network, keycache
 from consys.client import root
 
-_config = configuration.register_section('network', 
-    {
+_spec = {
         'server-string': 'string()',
         'client-key': 'path(default=keys/client)',
         'server-public-key': 'path(default=keys/server.pub)',
         'client-user-name': 'string(default=terminal)',
-    })
+    }
+_spec.update(network.BACKOFF_SPEC)
+_config = configuration.register_section('network', _spec)
 
 _log = log.getLogger(__name__)
 
 class ClientTransport(network.SSHClientTransport):
-    def __init__(self, knownHostKey, deferred, onDisconnect):
+    def __init__(self, knownHostKey, deferred, onDisconnect,
+                 connectionFactory=None):
         network.SSHClientTransport.__init__(self, knownHostKey, deferred,
-                                            onDisconnect, SSHConnection)
+                                            onDisconnect,
+                                            connectionFactory or SSHConnection)
 
     def getAuthenticator(self, connection):
         username = _config['client-user-name'].encode('utf-8')
@@ -49,12 +52,11 @@ class SimplePubkeyUserAuth(userauth.SSHUserAuthClient):
         if not os.path.exists(path) or self.lastPublicKey:
             return
         # public blob of a private key
-        key = keys.Key.fromFile(path)
-        return key.public()
+        return keycache.get_public_key(path)
 
     def getPrivateKey(self):
         path = _config['client-key']
-        return defer.succeed(keys.Key.fromFile(path))
+        return defer.succeed(keycache.get_key(path))
     
     def getPassword(self):
         return
@@ -70,7 +72,7 @@ class SSHConnection(connection.SSHConnection):
         try:
             connection.SSHConnection.serviceStarted(self)
             _log.info('Authentication successful')
-            self.mind = root.Root()
+            self.mind = self.makeMind()
             rpcRoot = self.rpcFactory.getRootObject()
             rpcRoot.addCallback(self.initRpc)
             rpcRoot.addErrback(self.deferred.errback)
@@ -78,6 +80,10 @@ class SSHConnection(connection.SSHConnection):
             _log.exception('Cannot start SSHConnection service')
             self.transport.loseConnection()
         
+    def makeMind(self):
+        ''' Returns the object the server is given to make calls on. '''
+        return root.Root()
+
     def serviceStopped(self):
         self.onDisconnect()
         self.rpcFactory.disconnect()
@@ -104,20 +110,27 @@ def _cbConnectionLost():
     autoConnection.event('connectionLost')
 
 _client_factory = protocol.Factory()
-_client_factory.protocol = lambda: ClientTransport(_server_public_key,
-                                                   autoConnection.deferred,
-                                                   _cbConnectionLost)
-
-_server_public_key = keys.Key.fromFile(_config['server-public-key'])
+_client_factory.protocol = lambda: ClientTransport(
+    keycache.get_key(_config['server-public-key']),
+    autoConnection.deferred, _cbConnectionLost)
 
 autoConnection = network.ConnectionAutomaton(_client_factory)
-autoConnection.server_string = _config['server-string']
 
 def on_startup():
+    autoConnection.configure(_config)
+    autoConnection.server_string = _config['server-string']
     autoConnection.event('connect')
 
 def on_shutdown():
     autoConnection.event('disconnect')
 
+def on_reload(changes):
+    if any(key in network.BACKOFF_SPEC for key in changes):
+        autoConnection.configure(_config)
+    if 'server-string' in changes:
+        # Used from the next connection attempt on
+        autoConnection.server_string = _config['server-string']
+
 app.startup.connect(on_startup)
 app.shutdown.connect(on_shutdown)
+configuration.register_reload_handler(on_reload, 'network')
@@ -1,20 +1,31 @@
 '''
-Persistent storage support. Based on Shelve.
+Persistent storage support. A small JSON key/value store, written
+atomically, so a terminal powered off in the middle of a write keeps
+either the old or the new contents.
 @author: Nikita Ofitserov
 '''
 
 from __future__ import unicode_literals
 
+import collections
+import json
+import os
+import os.path
 import shelve
+import whichdb
 
 from notify.all import Signal
 
+from twisted.internet import reactor
 
 from consys.common import log
 from consys.common import configuration, app
 
-_config = configuration.register_section('client-persistence', 
+_config = configuration.register_section('client-persistence',
     {
+        'store-file': 'path(default=data/client.json)',
+        'flush-delay': 'float(min=0, default=0.5)',
+        # Old shelve database, migrated into store-file on first start
         'db-file': 'path(default=data/client.db)',
     })
 
@@ -26,9 +37,112 @@ ready = Signal()
 storage = None
 '''The storage dict-like object'''
 
+
+class CompactStore(collections.MutableMapping):
+    '''
+    Dict-like store kept in a JSON file. Changes are written flush_delay
+    seconds after the first one, all at once, to a temporary file which
+    is fsynced and renamed over the store.
+    '''
+
+    def __init__(self, path, flush_delay):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._data = {}
+        self._timer = None
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self._data = json.loads(f.read().decode('utf-8'))
+        except (IOError, ValueError) as e:
+            _log.error('Cannot read {0}, starting empty: {1}'.format(
+                self.path, e))
+            self._data = {}
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._changed()
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._changed()
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _changed(self):
+        if self._timer is None:
+            self._timer = reactor.callLater(self.flush_delay, self.flush)
+
+    def flush(self):
+        '''Writes pending changes to disk.'''
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        temp_path = self.path + '.tmp'
+        data = json.dumps(self._data, separators=(',', ':'), sort_keys=True)
+        with open(temp_path, 'wb') as f:
+            f.write(data.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.path)
+        directory = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def close(self):
+        if self._timer is not None:
+            self.flush()
+
+
+def _migrate_shelve(store, path):
+    '''Copies the contents of an old shelve database into the store. An
+    unreadable database is moved aside and the store is left empty.'''
+    try:
+        if not whichdb.whichdb(path):
+            return
+        _log.info('Migrating {0} to {1}'.format(path, store.path))
+        old = shelve.open(path, flag='r')
+        try:
+            for key, value in old.iteritems():
+                store[key.decode('utf-8')] = value
+        finally:
+            old.close()
+    except Exception as e:
+        _log.error('Cannot migrate {0}, starting empty: {1!r}'.format(
+            path, e))
+        store.clear()
+        _move_aside(path)
+    store.flush()
+
+def _move_aside(path):
+    '''Renames the files of a dbm database to *.broken.'''
+    for suffix in ('', '.db', '.dir', '.dat', '.bak', '.pag'):
+        name = path + suffix
+        if os.path.exists(name):
+            try:
+                os.rename(name, name + '.broken')
+            except OSError as e:
+                _log.error('Cannot move {0} aside: {1}'.format(name, e))
+
 def on_startup():
     global storage
-    storage = shelve.open(_config['db-file'])
+    exists = os.path.exists(_config['store-file'])
+    storage = CompactStore(_config['store-file'], _config['flush-delay'])
+    if not exists:
+        _migrate_shelve(storage, _config['db-file'])
     ready()
 
 def on_shutdown():
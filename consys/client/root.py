@@ -16,19 +16,35 @@ TERMINAL_ID_ENTRY = b'terminal-id'
 class Root(pb.Referenceable):
     
     def __init__(self):
-        self.locker = locker.Locker()
+        self._locker = None
         if not TERMINAL_ID_ENTRY in persistent.storage:
             persistent.storage[TERMINAL_ID_ENTRY] = self.terminal_id = None
         else:
             self.terminal_id = persistent.storage[TERMINAL_ID_ENTRY]
             _log.debug('Terminal id is {0}'.format(self.terminal_id))
     
+    @property
+    def locker(self):
+        '''The screen locker, connecting to DBus on first use.'''
+        if self._locker is None:
+            self._locker = locker.Locker()
+        return self._locker
+
     def remote_shutdown(self):
         reactor.stop()
         
     def remote_get_locker(self):
         return self.locker
+
+    def remote_lock(self):
+        return self.locker.lock()
+
+    def remote_unlock(self):
+        return self.locker.unlock()
     
+    def remote_ping(self):
+        pass
+
     def remote_get_terminal_id(self):
         return self.terminal_id
     
@@ -36,6 +52,9 @@ class Root(pb.Referenceable):
         _log.info('Got assigned terminal id {0}'.format(id))
         self.terminal_id = id
         persistent.storage[TERMINAL_ID_ENTRY] = id
+        # The server takes the answer as the id being kept, it must
+        # survive a power loss right after it
+        persistent.storage.flush()
 
     def remote_call_dbus(self, bus, bus_name, object_path, iface_name,
                             method, args):
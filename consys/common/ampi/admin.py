@@ -10,6 +10,60 @@ class NoSuchObjectError(Exception):
 class TerminalOfflineError(Exception):
     pass
 
+class ChangesUnavailableError(Exception):
+    pass
+
+class InvalidSelectorError(Exception):
+    pass
+
+class UnknownOperationError(Exception):
+    pass
+
+class ChunkedAmpList(amp.AmpList):
+    '''
+    An AmpList that may exceed the AMP value length limit. The encoded
+    boxes are split into values of at most MAX_VALUE_LENGTH bytes under
+    keys name, name.1, name.2 and so on.
+    '''
+
+    def toStringProto(self, inObject, proto):
+        chunks = []
+        size = amp.MAX_VALUE_LENGTH
+        for objects in inObject:
+            box = amp.AmpList.toStringProto(self, [objects], proto)
+            if size + len(box) > amp.MAX_VALUE_LENGTH:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(box)
+            size += len(box)
+        return [b''.join(chunk) for chunk in chunks] or [b'']
+
+    def toBox(self, name, strings, objects, proto):
+        amp.AmpList.toBox(self, name, strings, objects, proto)
+        if name in strings:
+            chunks = strings.pop(name)
+            strings[name] = chunks[0]
+            for index, chunk in enumerate(chunks[1:], 1):
+                strings[_chunk_key(name, index)] = chunk
+
+    def fromBox(self, name, strings, objects, proto):
+        if name in strings:
+            chunks = [strings[name]]
+            index = 1
+            while _chunk_key(name, index) in strings:
+                chunks.append(strings.pop(_chunk_key(name, index)))
+                index += 1
+            strings[name] = b''.join(chunks)
+        amp.AmpList.fromBox(self, name, strings, objects, proto)
+
+def _chunk_key(name, index):
+    return name + b'.' + str(index).encode('ascii')
+
+_terminal_event = [(b'kind', amp.String()),
+                   (b'id', amp.Integer()),
+                   (b'name', amp.String(optional=True)),
+                   (b'online', amp.Boolean(optional=True))]
+
 # Common commands
 
 class Ping(amp.Command):
@@ -25,30 +79,101 @@ class GetTerminals(amp.Command):
 class GetTerminalData(amp.Command):
     arguments = [(b'id', amp.Integer())]
     response = [(b'name', amp.String()),
-                (b'online', amp.Boolean())]
+                (b'online', amp.Boolean()),
+                (b'rtt', amp.Float(optional=True))]
     errors = {NoSuchObjectError: "NO_SUCH_OBJECT"}
 
+class GetTerminalsSnapshot(amp.Command):
+    '''
+    Returns a page of terminals, ordered by id: those with ids greater
+    than after (all if it is None), at most limit of them and no more
+    than fit into an AMP value. more is true if there are terminals
+    after the page. epoch and seq of the first page (after is None)
+    identify the event batch the snapshot starts with; later pages may
+    already include later changes.
+    '''
+    arguments = [(b'after', amp.Integer(optional=True)),
+                 (b'limit', amp.Integer(optional=True))]
+    response = [(b'terminals', amp.AmpList([
+                    (b'id', amp.Integer()),
+                    (b'name', amp.String()),
+                    (b'online', amp.Boolean()),
+                    (b'workstation', amp.Integer(optional=True)),
+                    (b'rtt', amp.Float(optional=True)),
+                ])),
+                (b'more', amp.Boolean()),
+                (b'epoch', amp.String()),
+                (b'seq', amp.Integer())]
+
+class GetChangesSince(amp.Command):
+    '''
+    Returns terminal events that happened after the given event batch,
+    compacted to at most one event per terminal. Fails if the server
+    does not remember that far back or has been restarted (so the epoch
+    has changed); a full snapshot must be fetched then.
+    '''
+    arguments = [(b'epoch', amp.String()),
+                 (b'seq', amp.Integer())]
+    response = [(b'seq', amp.Integer()),
+                (b'events', amp.AmpList(_terminal_event))]
+    errors = {ChangesUnavailableError: "CHANGES_UNAVAILABLE"}
+
 class ShutdownTerminal(amp.Command):
     arguments = [(b'id', amp.Integer())]
     response = []
     errors = {NoSuchObjectError: "NO_SUCH_OBJECT",
               TerminalOfflineError: "TERMINAL_OFFLINE"}
     
+class BroadcastTerminals(amp.Command):
+    '''
+    Performs an operation ('lock', 'unlock' or 'shutdown') on many
+    terminals concurrently. Terminals are given either by a list of ids
+    or by a selector: 'all', 'online' or 'workstations' (terminals of the
+    listed workstations). Reports the outcome for every terminal; error is
+    NO_SUCH_OBJECT, TERMINAL_OFFLINE or a (possibly truncated) description
+    of the failure.
+    '''
+    arguments = [(b'operation', amp.String()),
+                 (b'ids', amp.ListOf(amp.Integer(), optional=True)),
+                 (b'selector', amp.String(optional=True)),
+                 (b'workstations', amp.ListOf(amp.Integer(), optional=True)),
+                 (b'concurrency', amp.Integer(optional=True))]
+    response = [(b'results', ChunkedAmpList([
+                    (b'id', amp.Integer()),
+                    (b'success', amp.Boolean()),
+                    (b'error', amp.String(optional=True)),
+                    (b'latency', amp.Float()),
+                ]))]
+    errors = {InvalidSelectorError: "INVALID_SELECTOR",
+              UnknownOperationError: "UNKNOWN_OPERATION"}
+
+class GetMetrics(amp.Command):
+    '''
+    Returns RPC statistics of the server: call and error counts, total
+    latency and latency histogram of every PB method called on clients
+    and every AMP command answered. counts[i] is the number of calls
+    with latency up to bounds[i] seconds, the last one has no bound.
+    '''
+    arguments = []
+    response = [(b'bounds', amp.ListOf(amp.Float())),
+                (b'methods', amp.AmpList([
+                    (b'link', amp.String()),
+                    (b'method', amp.String()),
+                    (b'calls', amp.Integer()),
+                    (b'errors', amp.Integer()),
+                    (b'total', amp.Float()),
+                    (b'counts', amp.ListOf(amp.Integer())),
+                ]))]
+
 # Server -> Admin commands
 
-class NewTerminal(amp.Command):
-    arguments = [(b'id', amp.Integer())]
+class TerminalEventsBatch(amp.Command):
+    '''
+    A batch of terminal events. Kind of each event is one of 'new',
+    'removed' or 'status'; 'name' is set for new terminals, 'online'
+    for new terminals and status updates.
+    '''
+    arguments = [(b'seq', amp.Integer()),
+                 (b'events', amp.AmpList(_terminal_event))]
     response = []
     requiresAnswer = False
-    
-class RemovedTerminal(amp.Command):
-    arguments = [(b'id', amp.Integer())]
-    response = []
-    requiresAnswer = False
-    
-class TerminalStatusUpdated(amp.Command):
-    arguments = [(b'id', amp.Integer()), (b'online', amp.Boolean())]
-    response = []
-    requiresAnswer = False
-
-    
\ No newline at end of file
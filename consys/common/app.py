@@ -7,7 +7,34 @@ from notify.all import Signal
 
 from twisted.internet import reactor
 
-startup = Signal()
+from consys.common import profiling
+
+class TimedSignal(Signal):
+    '''A signal whose handlers are timed when profiling is enabled.'''
+
+    def __init__(self, name):
+        Signal.__init__(self)
+        self.name = name
+        self._wrappers = {}
+        '''Timing wrappers connected instead of handlers, by handler'''
+
+    def connect(self, handler, *arguments, **keywords):
+        if profiling.enabled:
+            wrapper = profiling.timed_handler(self.name, handler)
+            self._wrappers.setdefault(handler, []).append(wrapper)
+            handler = wrapper
+        return Signal.connect(self, handler, *arguments, **keywords)
+
+    def disconnect(self, handler, *arguments, **keywords):
+        wrappers = self._wrappers.get(handler)
+        if wrappers:
+            wrapper = wrappers.pop()
+            if not wrappers:
+                del self._wrappers[handler]
+            handler = wrapper
+        return Signal.disconnect(self, handler, *arguments, **keywords)
+
+startup = TimedSignal('app.startup')
 ''' Is emitted when the app starts.
 '''
 
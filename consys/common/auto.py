@@ -17,8 +17,8 @@ class SimpleAutomaton(object):
             raise NameError('No transition from "{0}" on '
                             'event "{1}" exists'.format(self._state, event))
         newState, methods = self._transitions[key]
-        _log.info('Transition "{0}" -> "{1}" on event '
-                  '"{2}"'.format(self._state, newState, event))
+        _log.info('Transition "%s" -> "%s" on event "%s"',
+                  self._state, newState, event)
         for method in methods:
             getattr(self, method)()
         self._state = newState
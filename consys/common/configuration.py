@@ -6,7 +6,7 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
-from consys.common import log
+from consys.common import log, profiling
 from sys import exit
 import os
 import os.path
@@ -21,6 +21,8 @@ _log = log.getLogger(__name__)
 _parser = argparse.ArgumentParser()
 _parser.add_argument('-f', dest='daemonise', default=True, action='store_false',
                      help='do not daemonise')
+_parser.add_argument('--profile-startup', default=False, action='store_true',
+                     help='log how long each import and startup handler takes')
 _parser.add_argument('-c', '--config', default='/etc/consys/consys.conf',
                      help='configuration file path (must be absolute in daemon mode) (default: %(default)s)')
 _args = _parser.parse_args()
@@ -41,6 +43,7 @@ _config = ConfigObj(infile=_configpath, file_error=True,
                     configspec=_configspec)
 _validator = Validator()
 _reload_handlers = []
+_dirty = False
 
 _config['daemonise'] = _args.daemonise
 
@@ -61,22 +64,71 @@ _validator.functions['path'] = _validate_path
 def filename():
     return _configpath
 
-def get_config(section=None):
-    if _config is not None:
-        if section is None:
-            return _config
-        else:
-            return _config[section]
-    else:
-        return None
+class Section(object):
+    '''
+    A configuration section (the root one if name is None) which is
+    validated on first access after new sections have been registered,
+    so that registering many sections costs a single validation. Modules
+    should not read values at import time, but in startup handlers or
+    later: the run() functions validate all sections at once after the
+    imports.
+    '''
 
-def register_section(name, dict):
-    if name is None:
-        _configspec.update(dict)
-    else:
-        _configspec[name] = dict
-    res = _config.validate(_validator, preserve_errors=True)
-    for section_list, key, error in flatten_errors(_config, res):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<Section({0})>'.format(self.name)
+
+    def section(self):
+        '''Returns the validated ConfigObj section.'''
+        validate()
+        return _config if self.name is None else _config[self.name]
+
+    def __getitem__(self, key):
+        return self.section()[key]
+
+    def __setitem__(self, key, value):
+        self.section()[key] = value
+
+    def __contains__(self, key):
+        return key in self.section()
+
+    def __iter__(self):
+        return iter(self.section())
+
+    def get(self, key, default=None):
+        return self.section().get(key, default)
+
+    def dict(self):
+        return self.section().dict()
+
+
+def validate():
+    '''
+    Validates the configuration against all sections registered so far,
+    unless it has been validated since. Reports all errors at once and
+    exits if there are any.
+    '''
+    global _dirty
+    if not _dirty:
+        return
+    _dirty = False
+    with profiling.timed('configuration validation'):
+        errors = _validate(_config)
+    if errors:
+        for error in errors:
+            _log.critical(error)
+        _log.critical('Errors in configuration. Exiting')
+        exit(1)
+
+def _validate(config):
+    '''Validates config, returns a list of error descriptions.'''
+    res = config.validate(_validator, preserve_errors=True)
+    if res is True:
+        return []
+    errors = []
+    for section_list, key, error in flatten_errors(config, res):
         if key is not None:
             section_list.append(key)
         else:
@@ -84,20 +136,68 @@ def register_section(name, dict):
         section_string = ' -> '.join(section_list)
         if error == False:
             error = 'Missing value or section'
-        _log.critical(section_string + ': ' + unicode(error))
-    if res is not True:
-        _log.critical('Errors in configuration. Exiting')
-        exit()  # FIXME
+        errors.append(section_string + ': ' + unicode(error))
+    return errors
+
+def get_config(section=None):
+    return Section(section)
+
+def register_section(name, dict):
+    global _dirty
     if name is None:
-        return _config
+        _configspec.update(dict)
     else:
-        return _config[name]
+        _configspec[name] = dict
+    _dirty = True
+    return Section(name)
 
-def register_reload_handler(callback):
-    _reload_handlers.append(callback)
+def register_reload_handler(callback, section=None):
+    '''
+    Registers callback(changes) to be called after a reload which has
+    changed any value of the section (the root one if section is None).
+    changes maps every changed key to a tuple (old value, new value).
+    '''
+    _reload_handlers.append((section, callback))
+
+def _values(section):
+    '''Returns a dict of the values (not subsections) of a section.'''
+    config = _config if section is None else _config.get(section, {})
+    return dict((key, value) for key, value in config.items()
+                if not isinstance(value, dict))
 
 def reload(signum=None, frame=None):
+    '''Reloads the configuration file. Called as a signal handler, defers
+    the work to the reactor, so that handlers never run in the middle of
+    another callback.'''
+    if signum is not None:
+        from twisted.internet import reactor
+        reactor.callFromThread(reload)
+        return
+    global _dirty
     _log.info('Reloading configuration')
+    new = ConfigObj(infile=_configpath, file_error=True,
+                    configspec=_configspec)
+    errors = _validate(new)
+    if errors:
+        for error in errors:
+            _log.error(error)
+        _log.error('Errors in configuration, keeping the current one')
+        return
+    old = dict((section, _values(section))
+               for section, _ in _reload_handlers)
     _config.reload()
-    for handler in _reload_handlers:
-        handler.__call__()
+    _config['daemonise'] = _args.daemonise
+    _dirty = True
+    validate()
+    for section, handler in _reload_handlers:
+        old_values = old[section]
+        changes = dict((key, (old_values.get(key), value))
+                       for key, value in _values(section).items()
+                       if old_values.get(key) != value)
+        if changes:
+            _log.info('Changed in [{0}]: {1}'.format(section or 'root',
+                                                     ', '.join(changes)))
+            try:
+                handler(changes)
+            except Exception:
+                _log.exception('Cannot apply changed configuration')
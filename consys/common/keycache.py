@@ -0,0 +1,65 @@
+''' Cache of SSH keys loaded from files.
+
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import os
+
+from twisted.conch.ssh import keys
+
+from consys.common import log
+
+__all__ = ['get_key', 'get_public_key', 'get_public_blob', 'clear']
+
+_log = log.getLogger(__name__)
+
+
+class _Entry(object):
+    def __init__(self, stamp, key):
+        self.stamp = stamp
+        self.key = key
+        self.public = None
+        self.blob = None
+
+
+_cache = {}
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def _entry(path):
+    stamp = _stamp(path)
+    entry = _cache.get(path)
+    if entry is None or entry.stamp != stamp:
+        _log.debug('Loading key {0}'.format(path))
+        entry = _Entry(stamp, keys.Key.fromFile(path))
+        _cache[path] = entry
+    return entry
+
+def get_key(path):
+    ''' Returns the key stored in the file, parsing it only if the file has
+    changed since the last call.
+    '''
+    return _entry(path).key
+
+def get_public_key(path):
+    ''' Returns the public part of the key stored in the file. '''
+    entry = _entry(path)
+    if entry.public is None:
+        entry.public = entry.key.public()
+    return entry.public
+
+def get_public_blob(path):
+    ''' Returns the public blob of the key stored in the file. '''
+    entry = _entry(path)
+    if entry.blob is None:
+        entry.blob = entry.key.blob()
+    return entry.blob
+
+def clear():
+    ''' Forgets all cached keys. '''
+    _cache.clear()
@@ -0,0 +1,150 @@
+'''
+Reactor lag monitor. Measures how late a periodic call runs (which is
+how long the reactor has been blocked by some callback) and, with a
+watchdog thread, catches what the reactor thread was doing meanwhile.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import collections
+import sys
+import thread
+import threading
+import time
+import traceback
+
+from twisted.internet import reactor, task
+
+from consys.common import log
+from consys.common import configuration, app, metrics
+
+_config = configuration.register_section('reactor-lag',
+    {
+        'enabled': 'boolean(default=True)',
+        'interval': 'float(min=0.05, default=0.5)',
+        # Lag in seconds above which a stall is logged
+        'threshold': 'float(min=0.01, default=0.2)',
+        'watchdog': 'boolean(default=True)',
+        # Number of recent stalls kept for inspection
+        'history': 'integer(min=1, default=20)',
+    })
+
+_log = log.getLogger(__name__)
+
+Stall = collections.namedtuple('Stall', 'time lag stack')
+'''A reactor stall: when it ended, how long it was and the stack running
+in the reactor thread during it (None if unknown).'''
+
+
+class LagMonitor(object):
+    '''
+    Runs a call every interval seconds and records the drift of each run
+    in its own histogram (stats, kept apart from the RPC metrics). A drift
+    over threshold is logged together with the reactor thread stack,
+    sampled by the watchdog thread while the reactor was blocked, and the
+    slowest recent stalls.
+    '''
+
+    def __init__(self, config=None):
+        self.interval = None
+        self.threshold = None
+        self.stats = metrics.MethodStats('reactor', 'lag')
+        '''Lag histogram, errors count stalls'''
+        self.last = 0.0
+        '''Last measured lag'''
+        self.max = 0.0
+        '''Maximum lag since take_max()'''
+        self.stalls = collections.deque()
+        '''Recent stalls, most recent last'''
+        self._expected = None
+        self._tick_time = None
+        self._stack = None
+        self._reactor_thread = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._loop = task.LoopingCall(self._tick)
+        if config is not None:
+            self.configure(config)
+
+    def configure(self, config):
+        '''Takes the parameters from a [reactor-lag] section. Must be
+        called before start().'''
+        self.interval = config['interval']
+        self.threshold = config['threshold']
+        self.stalls = collections.deque(self.stalls,
+                                        maxlen=config['history'])
+
+    def start(self, watchdog=True):
+        self._expected = self._tick_time = time.time()
+        self._loop.start(self.interval, now=False)
+        self._expected += self.interval
+        if watchdog:
+            self._watchdog = threading.Thread(target=self._watch,
+                                              name='reactor-watchdog')
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._loop.running:
+            self._loop.stop()
+
+    def take_max(self):
+        value, self.max = self.max, self.last
+        return value
+
+    def slowest(self, count=5):
+        '''Returns the slowest recent stalls, slowest first.'''
+        return sorted(self.stalls, key=lambda s: s.lag, reverse=True)[:count]
+
+    def _tick(self):
+        # The reactor may run in another thread than the one starting it
+        self._reactor_thread = thread.get_ident()
+        now = time.time()
+        lag = max(now - self._expected, 0.0)
+        self._expected = now + self.interval
+        self._tick_time = now
+        stack, self._stack = self._stack, None
+        self.last = lag
+        self.max = max(self.max, lag)
+        self.stats.record(lag, lag > self.threshold)
+        if lag > self.threshold:
+            self.stalls.append(Stall(now, lag, stack))
+            _log.warning('Reactor was blocked for {0:.3f}s{1}\n'
+                         'Slowest recent stalls:\n{2}'.format(lag,
+                ', running:\n' + ''.join(stack) if stack else '',
+                '\n'.join(_describe(stall) for stall in self.slowest())))
+
+    def _watch(self):
+        # Samples the reactor thread once per stall, at the point where
+        # the tick is already threshold late.
+        limit = self.interval + self.threshold
+        while not self._stopped.wait(self.threshold / 2):
+            tick_time = self._tick_time
+            if self._stack is None and time.time() - tick_time > limit:
+                frame = sys._current_frames().get(self._reactor_thread)
+                if frame is not None:
+                    self._stack = traceback.format_stack(frame)
+                del frame
+
+def _describe(stall):
+    '''Returns a line about a stall: its lag, time and innermost frame.'''
+    where = stall.stack[-1].strip().replace('\n', ':') if stall.stack \
+        else 'unknown'
+    return '  {0:.3f}s at {1}, in {2}'.format(stall.lag,
+        time.strftime('%H:%M:%S', time.localtime(stall.time)), where)
+
+monitor = LagMonitor()
+'''The process-wide monitor, configured at startup'''
+
+def on_startup():
+    monitor.configure(_config)
+    if _config['enabled']:
+        monitor.start(_config['watchdog'])
+
+def on_shutdown():
+    monitor.stop()
+
+app.startup.connect(on_startup)
+app.shutdown.connect(on_shutdown)
@@ -7,7 +7,11 @@ Logging wrapper.
 
 from __future__ import unicode_literals
 
+import atexit
+import os
 import os.path
+import Queue
+import threading
 
 import logging
 import logging.handlers
@@ -25,6 +29,110 @@ _log_stderr.setLevel(logging.ERROR)
 _log_stderr.setFormatter(_stderr_formatter)
 logging.getLogger('consys.common.configuration').addHandler(_log_stderr)
 
+class AsyncHandler(logging.Handler):
+    '''
+    Passes records to the target handlers in a background thread, so
+    that formatting and writing never block the caller. The queue is
+    bounded: when it is full records are dropped and counted, and the
+    number of dropped records is logged once there is room again.
+    The thread is started on first use, so it survives daemonisation.
+    '''
+
+    def __init__(self, handlers, size):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+        self._reported = 0
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    # Forked: the parent's writer thread may have held
+                    # any of the locks, replace them
+                    self.queue = Queue.Queue(self.queue.maxsize)
+                    for handler in self.handlers:
+                        handler.createLock()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._write,
+                                                name='log-writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            # Merge the arguments now, the caller may change them before
+            # the writer thread gets to the record
+            record.msg = record.getMessage()
+            record.args = None
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            if self.dropped != self._reported:
+                dropped = self.dropped
+                self._handle(logging.LogRecord(__name__, logging.WARNING,
+                    __file__, 0, 'Log queue overflow, dropped %d records',
+                    (dropped - self._reported,), None))
+                self._reported = dropped
+            self._handle(record)
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close(self):
+        '''Writes out the queued records and stops the thread.'''
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(5)
+        for handler in self.handlers:
+            handler.flush()
+        logging.Handler.close(self)
+
+
+_async_handler = None
+_file_handler = None
+_syslog_handler = None
+
+def _attach(handler):
+    if _async_handler is not None:
+        # Replaced rather than changed, the writer thread iterates it
+        _async_handler.handlers = _async_handler.handlers + [handler]
+    else:
+        _root_log.addHandler(handler)
+
+def _detach(handler):
+    if _async_handler is not None:
+        _async_handler.handlers = [h for h in _async_handler.handlers
+                                   if h is not handler]
+    else:
+        _root_log.removeHandler(handler)
+    handler.close()
+
+def _make_syslog_handler():
+    syslog_formatter = logging.Formatter(fmt='[%(name)s]: %(message)s')
+    log_syslog = logging.handlers.SysLogHandler(b'/dev/log')
+    log_syslog.setLevel(logging.INFO)
+    log_syslog.setFormatter(syslog_formatter)
+    return log_syslog
+
 def init(filename=None):
     from consys.common import daemonise
     from consys.common import configuration
@@ -33,24 +141,62 @@ def init(filename=None):
         {
             'syslog': 'boolean(default=False)',
             'logdir': 'path(default=None)',
+            'level': 'option(debug, info, warning, error, default=debug)',
+            'max-bytes': 'integer(min=0, default=65536)',
+            'backup-count': 'integer(min=0, default=3)',
+            # Write the log in a background thread
+            'async': 'boolean(default=True)',
+            'queue-size': 'integer(min=1, default=10000)',
         })
 
+    global _async_handler, _file_handler, _syslog_handler
+    _root_log.setLevel(getattr(logging, config['level'].upper()))
+    handlers = []
+
     if config['logdir'] is not None:
         logpath = os.path.join(config['logdir'], filename)
         file_formatter = logging.Formatter(fmt='%(asctime)s [%(name)s] -- %(message)s')
         log_file = logging.handlers.RotatingFileHandler(logpath,
-                        maxBytes=1024*64, backupCount=3)
+                        maxBytes=config['max-bytes'],
+                        backupCount=config['backup-count'])
         log_file.setLevel(logging.DEBUG)
         log_file.setFormatter(file_formatter)
-        _root_log.addHandler(log_file)
+        handlers.append(log_file)
         daemonise.preserve_handle(log_file.stream)
+        _file_handler = log_file
     
     if config['syslog']:
-        syslog_formatter = logging.Formatter(fmt='[%(name)s]: %(message)s')
-        log_syslog = logging.handlers.SysLogHandler(b'/dev/log')
-        log_syslog.setLevel(logging.INFO)
-        log_syslog.setFormatter(syslog_formatter)
-        _root_log.addHandler(log_syslog)
+        _syslog_handler = _make_syslog_handler()
+        handlers.append(_syslog_handler)
+
+    if config['async']:
+        _async_handler = AsyncHandler(handlers, config['queue-size'])
+        _root_log.addHandler(_async_handler)
+        atexit.register(_async_handler.close)
+    else:
+        for handler in handlers:
+            _root_log.addHandler(handler)
+
+    def on_reload(changes):
+        global _syslog_handler
+        if 'level' in changes:
+            _root_log.setLevel(getattr(logging, config['level'].upper()))
+        if _file_handler is not None:
+            _file_handler.maxBytes = config['max-bytes']
+            _file_handler.backupCount = config['backup-count']
+        if 'syslog' in changes:
+            if config['syslog'] and _syslog_handler is None:
+                _syslog_handler = _make_syslog_handler()
+                _attach(_syslog_handler)
+            elif not config['syslog'] and _syslog_handler is not None:
+                _detach(_syslog_handler)
+                _syslog_handler = None
+        for key in ('logdir', 'async', 'queue-size'):
+            if key in changes:
+                _root_log.warning('Changed log setting %s takes effect '
+                                  'after a restart', key)
+
+    configuration.register_reload_handler(on_reload, 'log')
     
     _root_log.info('Logging started')
 
@@ -0,0 +1,134 @@
+'''
+RPC call metrics: per-method call and error counts and latency
+histograms with fixed log-spaced buckets.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import bisect
+import time
+
+from twisted.python.failure import Failure
+
+BOUNDS = [0.0001 * 2 ** (i / 2.0) for i in range(41)]
+'''Upper bounds of the histogram buckets in seconds, 100us to ~105s.
+The last bucket (counts[len(BOUNDS)]) has no upper bound.'''
+
+
+class MethodStats(object):
+    '''Statistics of calls of one remote method.'''
+
+    __slots__ = ('link', 'method', 'calls', 'errors', 'total', 'counts',
+                 '_record')
+
+    def __init__(self, link, method):
+        self.link = link
+        self.method = method
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        '''Total latency in seconds'''
+        self.counts = [0] * (len(BOUNDS) + 1)
+        '''Calls by latency bucket, see BOUNDS'''
+        # Bound once, so that observing a call allocates no callbacks
+        self._record = self._recordResult
+
+    def __repr__(self):
+        return '<MethodStats({0} {1}: {2} calls, {3} errors)>'.format(
+            self.link, self.method, self.calls, self.errors)
+
+    def record(self, latency, failed):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.total += latency
+        self.counts[bisect.bisect_left(BOUNDS, latency)] += 1
+
+    def observe(self, started, deferred):
+        '''Records the outcome of a call started at the given time.time()
+        when the deferred fires. Returns the deferred.'''
+        return deferred.addBoth(self._record, started)
+
+    def _recordResult(self, result, started):
+        self.record(time.time() - started, isinstance(result, Failure))
+        return result
+
+    def percentile(self, p):
+        '''Returns the upper bound of the bucket holding the p-th
+        percentile, None if there have been no calls (or it falls into the
+        last, unbounded bucket).'''
+        rank = p / 100.0 * self.calls
+        seen = 0
+        for bound, count in zip(BOUNDS, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return None
+
+
+class Metrics(object):
+    '''All method statistics, by link ('pb', 'amp') and method name.'''
+
+    def __init__(self):
+        self.methods = {}
+
+    def __repr__(self):
+        return '<Metrics({0} methods)>'.format(len(self.methods))
+
+    def stats(self, link, method):
+        key = (link, method)
+        try:
+            return self.methods[key]
+        except KeyError:
+            stats = self.methods[key] = MethodStats(link, method)
+            return stats
+
+    def all(self):
+        '''Returns a list of all MethodStats sorted by link and method.'''
+        return [self.methods[key] for key in sorted(self.methods)]
+
+    def dump(self):
+        '''Returns a human-readable summary, one method per line.'''
+        lines = []
+        for stats in self.all():
+            mean = stats.total / stats.calls if stats.calls else 0
+            lines.append('{0} {1}: {2} calls, {3} errors, mean {4:.4f}s, '
+                         'p50 <{5}, p99 <{6}'.format(
+                             stats.link, stats.method, stats.calls,
+                             stats.errors, mean, stats.percentile(50),
+                             stats.percentile(99)))
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.methods.clear()
+
+registry = Metrics()
+'''Process-wide metrics'''
+
+
+class InstrumentedReference(object):
+    '''
+    Wraps a PB RemoteReference, recording every callRemote. Everything
+    else is passed through.
+    '''
+
+    def __init__(self, reference, link='pb'):
+        self._reference = reference
+        self._link = link
+        self._stats = {}
+
+    def __getattr__(self, name):
+        return getattr(self._reference, name)
+
+    def __repr__(self):
+        return '<InstrumentedReference({0!r})>'.format(self._reference)
+
+    def callRemote(self, _name, *args, **kw):
+        try:
+            stats = self._stats[_name]
+        except KeyError:
+            stats = self._stats[_name] = registry.stats(self._link, _name)
+        started = time.time()
+        return stats.observe(started,
+                             self._reference.callRemote(_name, *args, **kw))
@@ -15,6 +15,14 @@ from consys.common import log, auto
 
 _log = log.getLogger(__name__)
 
+BACKOFF_SPEC = {
+    'reconnect-initial-delay': 'float(min=0, default=1.0)',
+    'reconnect-factor': 'float(min=1, default=1.72)',
+    'reconnect-max-delay': 'float(min=0, default=15.0)',
+    'reconnect-jitter': 'float(min=0, max=1, default=0.12)',
+}
+'''Configuration spec of ConnectionAutomaton backoff, for network sections'''
+
 class InvalidHostKey(Exception):
     def __init__(self, host, offendingKey, validKey):
         Exception.__init__(self, host, offendingKey, validKey)
@@ -78,6 +86,7 @@ class ProtocolChannel(channel.SSHChannel):
                                     remoteWindow, remoteMaxPacket, conn,
                                     data, avatar)
         self.factory = factory
+        self.protocol = None
         self.deferred = defer.Deferred()
 
     def openFailed(self, reason):
@@ -90,6 +99,11 @@ class ProtocolChannel(channel.SSHChannel):
 
     def dataReceived(self, data):
         self.protocol.dataReceived(data)
+
+    def closed(self):
+        channel.SSHChannel.closed(self)
+        if self.protocol is not None:
+            self.protocol.connectionLost(Failure(error.ConnectionDone()))
         
     # TODO: Add new IAddress implementation for SSH channels
     def getPeer(self):
@@ -155,8 +169,10 @@ class ConnectionAutomaton(auto.SimpleAutomaton):
     max_delay = 15.0 # seconds
     jitter = 0.12
     
-    def __init__(self, factory):
+    def __init__(self, factory, config=None):
         auto.SimpleAutomaton.__init__(self)
+        if config is not None:
+            self.configure(config)
         self.connection = None
         self.deferred = None
         self.server_string = None
@@ -164,6 +180,20 @@ class ConnectionAutomaton(auto.SimpleAutomaton):
         self.delay = self.initial_delay
         self.factory = factory
         
+    def configure(self, config):
+        '''Takes the backoff parameters from a section with BACKOFF_SPEC.
+        Unless disconnected, the current delay is only clamped, so a
+        reconnect in progress is not reset.'''
+        self.initial_delay = config['reconnect-initial-delay']
+        self.factor = config['reconnect-factor']
+        self.max_delay = config['reconnect-max-delay']
+        self.jitter = config['reconnect-jitter']
+        if self._state == 'disconnected':
+            self.delay = self.initial_delay
+        else:
+            self.delay = min(max(self.delay, self.initial_delay),
+                             self.max_delay)
+
     def doConnect(self):
         if self.connection is not None:
             self.disconnect()
@@ -0,0 +1,104 @@
+'''
+Startup timing: how long module imports, configuration validation and
+startup handlers take.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import __builtin__
+import collections
+import contextlib
+import importlib
+import sys
+import time
+
+from consys.common import log
+
+_log = log.getLogger(__name__)
+
+_started = time.time()
+_timings = collections.OrderedDict()
+
+enabled = False
+'''Whether detailed startup profiling (--profile-startup) is on'''
+
+_original_import = __builtin__.__import__
+
+
+def add(name, seconds):
+    '''Adds seconds to the time spent in the named step.'''
+    _timings[name] = _timings.get(name, 0.0) + seconds
+
+@contextlib.contextmanager
+def timed(name):
+    '''Times the enclosed block as the named step.'''
+    started = time.time()
+    try:
+        yield
+    finally:
+        add(name, time.time() - started)
+
+def _timed_import(name, globals=None, locals=None, fromlist=None,
+                  level=-1):
+    # Modules the statement may load: the module itself and, for
+    # 'from package import name', the submodules named
+    candidates = [name] + ['{0}.{1}'.format(name, item)
+                           for item in fromlist or () if item != '*']
+    missing = [module for module in candidates if module not in sys.modules]
+    if not missing:
+        return _original_import(name, globals, locals, fromlist, level)
+    started = time.time()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        loaded = [module for module in missing if module in sys.modules]
+        if loaded:
+            add('import ' + ', '.join(loaded), time.time() - started)
+
+def enable():
+    '''Turns on detailed profiling: every module imported from now on is
+    timed (including the modules it imports), as is every handler of
+    signals created with TimedSignal.'''
+    global enabled
+    if not enabled:
+        enabled = True
+        __builtin__.__import__ = _timed_import
+
+def disable():
+    '''Stops timing imports.'''
+    global enabled
+    enabled = False
+    __builtin__.__import__ = _original_import
+
+def timed_handler(name, handler):
+    '''Returns handler wrapped to time its calls as the named step.'''
+    step = '{0}: {1}.{2}'.format(name, getattr(handler, '__module__', ''),
+                                 getattr(handler, '__name__', handler))
+    def _timed(*args, **kwargs):
+        with timed(step):
+            return handler(*args, **kwargs)
+    return _timed
+
+def import_modules(package, names):
+    '''Imports package.name for every name, timing each import.'''
+    for name in names:
+        module = '{0}.{1}'.format(package, name)
+        if enabled:
+            # Timed by the import hook
+            importlib.import_module(module)
+        else:
+            with timed('import ' + module):
+                importlib.import_module(module)
+
+def timings():
+    '''Returns a list of (step, seconds), slowest first.'''
+    return sorted(_timings.items(), key=lambda item: item[1], reverse=True)
+
+def report():
+    '''Logs the time from the start of the process and the steps. Ends
+    detailed profiling. Import times include nested imports.'''
+    disable()
+    _log.info('Started in {0:.3f}s'.format(time.time() - _started))
+    for name, seconds in timings():
+        _log.info('  {0:.3f}s {1}'.format(seconds, name))
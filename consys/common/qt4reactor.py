@@ -39,7 +39,7 @@ Subsequent port by therve
 __all__ = ['install']
 
 
-import sys, time
+import math, sys, time
 
 from zope.interface import implements
 
@@ -136,10 +136,7 @@ class QTReactor(PosixReactorBase):
             self.qApp = QCoreApplication.instance()
             self._ownApp=False
         self._blockApp = None
-        self._readWriteQ=[]
-        
-        """ some debugging instrumentation """
-        self._doSomethingCount=0
+        self._deadline = None
         
         PosixReactorBase.__init__(self)
 
@@ -181,11 +178,20 @@ class QTReactor(PosixReactorBase):
     
     def callLater(self,howlong, *args, **kargs):
         rval = super(QTReactor,self).callLater(howlong, *args, **kargs)
-        self.reactorInvocation()
+        self._armBefore(rval.getTime())
         return rval
-    
+
+    def _moveCallLaterSooner(self, delayedCall):
+        super(QTReactor,self)._moveCallLaterSooner(delayedCall)
+        self._armBefore(delayedCall.getTime())
+
+    def stop(self):
+        super(QTReactor,self).stop()
+        self.reactorInvocation()
+
     def crash(self):
         super(QTReactor,self).crash()
+        self.reactorInvocation()
         
     def iterate(self,delay=0.0):
         t=self.running # not sure I entirely get the state of running
@@ -194,7 +200,7 @@ class QTReactor(PosixReactorBase):
         try:
             if delay == 0.0:
                 self.reactorInvokePrivate()
-                self._timer.stop() # supports multiple invocations
+                self._arm(None) # supports multiple invocations
             else:
                 endTime = delay + time.time()
                 self.reactorInvokePrivate()
@@ -206,9 +212,6 @@ class QTReactor(PosixReactorBase):
         finally:
             self.running=t
             
-    def addReadWrite(self,t):
-        self._readWriteQ.append(t)
-        
     def runReturn(self, installSignalHandlers=True):
         QObject.connect(self._timer, SIGNAL("timeout()"), 
                         self.reactorInvokePrivate)
@@ -227,19 +230,40 @@ class QTReactor(PosixReactorBase):
             self._timer.stop() # should already be stopped
 
     def reactorInvocation(self):
-        self._timer.setInterval(0)
-        
+        """
+        Run pending calls as soon as control gets back to the Qt loop.
+        """
+        self._arm(0)
+
+    def _arm(self, timeout):
+        """
+        Arm the timer to fire in timeout seconds (rounded up to whole
+        milliseconds, so that the calls are due when it fires), or disarm
+        it if timeout is None.
+        """
+        if timeout is None:
+            self._deadline = None
+            self._timer.stop()
+        else:
+            timeout = max(timeout, 0)
+            self._deadline = self.seconds() + timeout
+            self._timer.start(int(math.ceil(timeout * 1000)))
+
+    def _armBefore(self, when):
+        """
+        Make sure the timer fires no later than at the given time.
+        """
+        if self._deadline is None or when < self._deadline:
+            self._arm(when - self.seconds())
+
     def reactorInvokePrivate(self):
+        self._deadline = None
+        self.runUntilCurrent()
         if not self.running:
+            self._timer.stop()
             self._blockApp.quit()
-        self._doSomethingCount += 1
-        self.runUntilCurrent()
-        t = self.timeout()
-        if t is None: t=0.1
-        else: t = min(t,0.1)
-        self._timer.setInterval(t*1010)
-        self.qApp.processEvents() # could change interval
-        self._timer.start()
+            return
+        self._arm(self.timeout())
                 
     def doIteration(self):
         assert False, "doiteration is invalid call"
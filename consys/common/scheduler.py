@@ -4,25 +4,36 @@
 
 from __future__ import unicode_literals
 
+import collections
 import threading
-from time import sleep
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from consys.common import log
-from consys.common import configuration
+from consys.common import configuration, app
 
-__all__ = ['schedule', 'Future']
+__all__ = ['schedule', 'Future', 'QueueFullError']
 
 _config = configuration.register_section('scheduler',
     {
         'thread-pool-size': 'integer(min=1, default=5)',
+        'queue-size': 'integer(min=0, default=1000)',
     })
 
 _log = log.getLogger(__name__)
 
-def schedule(self, task, args=()):
-    '''Schedules the call and returns a future'''
+class QueueFullError(Exception):
+    ''' The task queue is full or the pool is shutting down. '''
+    pass
+
+def schedule(task, args=()):
+    '''Schedules the call and returns a future. The future's deferred
+    attribute is a Deferred fired with the result in the reactor thread.
+    Raises QueueFullError if the task cannot be queued.'''
     future = Future()
-    self.pool.queueTask(task, args, future.set_result)
+    if not pool.queueTask(task, args, future.set_result, future.set_error):
+        raise QueueFullError('Cannot schedule {0!r}'.format(task))
     return future
         
 class Future:
@@ -32,7 +43,26 @@ class Future:
         self.event = threading.Condition(threading.Lock())
         self.ready = False 
         self.retval = None
+        self.error = None
         self.callback = None
+        self._deferred = None
+
+    @property
+    def deferred(self):
+        '''A Deferred fired with the result in the reactor thread. It is
+        created on first access, so a failure of a future nobody has asked
+        a Deferred for is not reported as an unhandled error.'''
+        self.event.acquire()
+        try:
+            fire = self._deferred is None and self.ready
+            if self._deferred is None:
+                self._deferred = defer.Deferred()
+            d = self._deferred
+        finally:
+            self.event.release()
+        if fire:
+            self._fire(d)
+        return d
     
     def set_callback(self, callback):
         self.event.acquire()
@@ -45,21 +75,42 @@ class Future:
             callback(self)
     
     def set_result(self, retval):
+        self._set(retval, None)
+
+    def set_error(self, failure):
+        self._set(None, failure)
+
+    def _set(self, retval, error):
         self.event.acquire()
         try:
             self.retval = retval
+            self.error = error
             self.ready = True
             self.event.notify_all()
+            d = self._deferred
         finally:
             self.event.release()
+        if d is not None:
+            self._fire(d)
         if self.callback is not None:
             self.callback(self)
+
+    def _fire(self, d):
+        from twisted.internet import reactor
+        if self.error is None:
+            reactor.callFromThread(d.callback, self.retval)
+        else:
+            reactor.callFromThread(d.errback, self.error)
             
     def get_result(self):
+        ''' Waits for the result and returns it, re-raising the exception
+        if the task has failed. '''
         self.event.acquire()
         try:
             while not self.ready: 
                 self.event.wait()
+            if self.error is not None:
+                self.error.raiseException()
             return self.retval
         finally:
             self.event.release()
@@ -67,15 +118,22 @@ class Future:
 class ThreadPool:
     '''Flexible thread pool class.  Creates a pool of threads, then
     accepts tasks that will be dispatched to the next available
-    thread.'''
+    thread. Idle threads sleep until a task arrives.'''
     
-    def __init__(self, numThreads):
-        '''Initialize the thread pool with numThreads workers.'''
+    def __init__(self, numThreads, maxQueueSize=0):
+        '''Initialize the thread pool with numThreads workers. At most
+        maxQueueSize tasks may wait in the queue, 0 means no limit.'''
         
         self.__threads = []
-        self.__resizeLock = threading.Condition(threading.Lock())
-        self.__taskLock = threading.Condition(threading.Lock())
-        self.__tasks = []
+        self.__resizeLock = threading.Lock()
+        lock = threading.Lock()
+        self.__taskLock = threading.Condition(lock)
+        # Signalled when the queue becomes empty, waited on by joinAll.
+        # Separate from __taskLock so that a queued task always wakes up
+        # a worker rather than joinAll.
+        self.__drained = threading.Condition(lock)
+        self.__tasks = collections.deque()
+        self.__maxQueueSize = maxQueueSize
         self.__isJoining = False
         self.setThreadCount(numThreads)
 
@@ -106,9 +164,15 @@ class ThreadPool:
             self.__threads.append(newThread)
             newThread.start()
         # If we need to shrink the pool, do so
-        while newNumThreads < len(self.__threads):
-            self.__threads[0].goAway()
-            del self.__threads[0]
+        if newNumThreads < len(self.__threads):
+            self.__taskLock.acquire()
+            try:
+                while newNumThreads < len(self.__threads):
+                    self.__threads[0].goAway()
+                    del self.__threads[0]
+                self.__taskLock.notify_all()
+            finally:
+                self.__taskLock.release()
 
     def getThreadCount(self):
         '''Return the number of threads in the pool.'''
@@ -119,9 +183,22 @@ class ThreadPool:
         finally:
             self.__resizeLock.release()
 
-    def queueTask(self, task, args=(), taskCallback=None):
+    def setMaxQueueSize(self, maxQueueSize):
+        '''Set the queue length limit, 0 means no limit. Tasks already
+        queued are kept.'''
+
+        self.__maxQueueSize = maxQueueSize
+
+    def getQueueLength(self):
+        '''Return the number of tasks waiting in the queue.'''
+
+        return len(self.__tasks)
+
+    def queueTask(self, task, args=(), taskCallback=None, errorCallback=None):
         '''Insert a task into the queue.  task must be callable;
-        taskCallback can be None.'''
+        taskCallback and errorCallback can be None. errorCallback is
+        given the Failure of a failed task. Returns False if the
+        task has not been queued.'''
         
         if self.__isJoining == True:
             return False
@@ -130,21 +207,30 @@ class ThreadPool:
         
         self.__taskLock.acquire()
         try:
-            self.__tasks.append((task, args, taskCallback))
+            if self.__maxQueueSize and \
+                    len(self.__tasks) >= self.__maxQueueSize:
+                return False
+            self.__tasks.append((task, args, taskCallback, errorCallback))
+            self.__taskLock.notify()
             return True
         finally:
             self.__taskLock.release()
 
-    def getNextTask(self):
-        ''' Retrieve the next task from the task queue.  For use
+    def getNextTask(self, thread):
+        ''' Retrieve the next task from the task queue, waiting for one
+        to arrive.  Returns None when the thread has to exit.  For use
         only by ThreadPoolThread objects contained in the pool.'''
         
         self.__taskLock.acquire()
         try:
-            if self.__tasks == []:
-                return (None, None, None)
-            else:
-                return self.__tasks.pop(0)
+            while not self.__tasks and not thread.isDying():
+                self.__taskLock.wait()
+            if thread.isDying():
+                return None
+            task = self.__tasks.popleft()
+            if not self.__tasks:
+                self.__drained.notify_all()
+            return task
         finally:
             self.__taskLock.release()
     
@@ -156,22 +242,29 @@ class ThreadPool:
         # Mark the pool as joining to prevent any more task queuing
         self.__isJoining = True
 
-        # Wait for tasks to finish
-        if waitForTasks:
-            while self.__tasks != []:
-                sleep(.1)
+        self.__taskLock.acquire()
+        try:
+            if waitForTasks:
+                # Wait for tasks to finish. Only workers signal the queue
+                # draining, a pool without threads would wait forever
+                while self.__tasks and self.__threads:
+                    self.__drained.wait()
+            else:
+                self.__tasks.clear()
+        finally:
+            self.__taskLock.release()
 
         # Tell all the threads to quit
         self.__resizeLock.acquire()
         try:
+            threads = list(self.__threads)
             self.__setThreadCountNolock(0)
             self.__isJoining = True
 
             # Wait until all threads have exited
             if waitForThreads:
-                for t in self.__threads:
+                for t in threads:
                     t.join()
-                    del t
 
             # Reset the pool for potential reuse
             self.__isJoining = False
@@ -182,32 +275,61 @@ class ThreadPool:
 class ThreadPoolThread(threading.Thread):
     ''' A pooled thread class. '''
     
-    threadSleepTime = 0.1
-
     def __init__(self, pool):
         ''' Initialize the thread and remember the pool. '''
         
         threading.Thread.__init__(self)
+        # An idle worker must not keep the process alive
+        self.daemon = True
         self.__pool = pool
         self.__isDying = False
         
     def run(self):
         ''' Until told to quit, retrieve the next task and execute
-        it, calling the set_result if any.  '''
+        it, calling its callback if any.  '''
         
-        while self.__isDying == False:
-            cmd, args, callback = self.__pool.getNextTask()
-            # If there's nothing to do, just sleep a bit
-            if cmd is None:
-                sleep(ThreadPoolThread.threadSleepTime)
-            elif callback is None:
-                cmd(*args)
+        while True:
+            task = self.__pool.getNextTask(self)
+            if task is None:
+                break
+            cmd, args, callback, errback = task
+            try:
+                result = cmd(*args)
+            except Exception:
+                if errback is None:
+                    _log.exception('Unhandled exception in scheduled task')
+                else:
+                    errback(Failure())
             else:
-                callback(cmd(*args))
+                if callback is not None:
+                    callback(result)
     
     def goAway(self):
-        ''' Exit the run loop next time through.'''
+        ''' Exit the run loop after the current task. The pool must wake
+        up idle threads after calling this.'''
         
         self.__isDying = True
 
-pool = ThreadPool(_config['thread-pool-size'])
+    def isDying(self):
+        return self.__isDying
+
+pool = ThreadPool(0)
+'''The process-wide pool. Its threads are started at startup, tasks
+scheduled earlier wait for them.'''
+
+def on_startup():
+    pool.setMaxQueueSize(_config['queue-size'])
+    pool.setThreadCount(_config['thread-pool-size'])
+
+def on_shutdown():
+    pool.joinAll(waitForTasks=False)
+
+def on_reload(changes):
+    if 'thread-pool-size' in changes:
+        pool.setThreadCount(_config['thread-pool-size'])
+    if 'queue-size' in changes:
+        pool.setMaxQueueSize(_config['queue-size'])
+
+app.startup.connect(on_startup)
+app.shutdown.connect(on_shutdown)
+configuration.register_reload_handler(on_reload, 'scheduler')
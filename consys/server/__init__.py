@@ -5,6 +5,7 @@ import signal
 from consys.common import log
 from consys.common import configuration
 from consys.common import daemonise
+from consys.common import profiling
 
 _log = log.getLogger(__name__)
 
@@ -30,9 +31,15 @@ def run():
             _log.info('Configuration file: {0}'.format(configuration.filename()))
             _log.info('Initializing ConSys server daemon...')
             from consys.common import app
-            from consys.server import network, persistent, hw, connections, \
-                ampserver
-            app.startup()
+            profiling.import_modules('consys.common', ['lag'])
+            profiling.import_modules('consys.server', [
+                'network', 'persistent', 'hw', 'connections', 'events',
+                'heartbeat', 'ampserver', 'exporter'])
+            # Every section is registered by now, validate them together
+            configuration.validate()
+            with profiling.timed('app.startup'):
+                app.startup()
+            profiling.report()
             app.dispatch_loop()
             _log.info('Terminating ConSys server daemon...')
     except Exception:
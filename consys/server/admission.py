@@ -0,0 +1,156 @@
+'''
+Admission control for incoming SSH/RPC handshakes.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import collections
+import time
+
+from consys.common import log
+from consys.common import configuration, app
+
+__all__ = ['AdmissionController', 'controller']
+
+_config = configuration.register_section('admission',
+    {
+        'max-handshakes': 'integer(min=1, default=32)',
+        'handshake-timeout': 'float(min=0, default=0.25)',
+        'timeout-per-queued': 'float(min=0, default=0.01)',
+        'max-handshake-time': 'float(min=0, default=30.0)',
+    })
+
+_log = log.getLogger(__name__)
+
+
+class Handshake(object):
+    '''A single connection going through admission.'''
+
+    def __init__(self, controller, admit):
+        self.controller = controller
+        self.admit = admit
+        self.queued_at = time.time()
+        self.started_at = None
+        self.done = False
+
+    @property
+    def started(self):
+        return self.started_at is not None
+
+    def finish(self):
+        '''Marks the handshake as successfully completed.'''
+        self.controller._finish(self, True)
+
+    def cancel(self):
+        '''Drops the handshake, whether it has been admitted or not.'''
+        self.controller._finish(self, False)
+
+
+class AdmissionController(object):
+    '''
+    Limits the number of SSH/RPC handshakes in progress. Connections over
+    the limit wait in a FIFO queue until a slot is freed. Handshake
+    deadlines grow with the queue, since a long queue means the server is
+    busy with key exchanges.
+    '''
+
+    def __init__(self, config=None):
+        self.limit = None
+        self.timeout = None
+        self.timeout_per_queued = None
+        self.max_time = None
+        '''Time an admitted connection may take to finish its handshake'''
+        if config is not None:
+            self.configure(config)
+        self.active = 0
+        self.queue = collections.deque()
+        # Counters
+        self.admitted = 0
+        self.queued = 0
+        self.max_queue_length = 0
+        self.completed = 0
+        self.aborted = 0
+        self.total_wait_time = 0.0
+        self.total_handshake_time = 0.0
+        self.longest_handshake = 0.0
+
+    def configure(self, config):
+        '''Takes the parameters from an [admission] section.'''
+        self.limit = config['max-handshakes']
+        self.timeout = config['handshake-timeout']
+        self.timeout_per_queued = config['timeout-per-queued']
+        self.max_time = config['max-handshake-time']
+
+    def request(self, admit):
+        '''
+        Requests a handshake slot. admit() is called as soon as the
+        handshake may proceed, possibly right away.
+        @rtype: Handshake
+        '''
+        handshake = Handshake(self, admit)
+        if self.active < self.limit:
+            self._start(handshake)
+        else:
+            self.queue.append(handshake)
+            self.queued += 1
+            self.max_queue_length = max(self.max_queue_length,
+                                        len(self.queue))
+            _log.debug('Handshake queued, {0} waiting'.format(len(self.queue)))
+        return handshake
+
+    def deadline(self):
+        '''Returns the time a client is given to finish its handshake.'''
+        return self.timeout + self.timeout_per_queued * len(self.queue)
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queue-length': len(self.queue),
+            'max-queue-length': self.max_queue_length,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'completed': self.completed,
+            'aborted': self.aborted,
+            'total-wait-time': self.total_wait_time,
+            'total-handshake-time': self.total_handshake_time,
+            'longest-handshake': self.longest_handshake,
+        }
+
+    def _start(self, handshake):
+        handshake.started_at = time.time()
+        self.active += 1
+        self.admitted += 1
+        self.total_wait_time += handshake.started_at - handshake.queued_at
+        try:
+            handshake.admit()
+        except Exception:
+            _log.exception('Cannot start admitted handshake')
+            handshake.cancel()
+
+    def _finish(self, handshake, completed):
+        if handshake.done:
+            return
+        handshake.done = True
+        if not handshake.started:
+            self.queue.remove(handshake)
+            self.aborted += 1
+            return
+        self.active -= 1
+        if completed:
+            duration = time.time() - handshake.started_at
+            self.completed += 1
+            self.total_handshake_time += duration
+            self.longest_handshake = max(self.longest_handshake, duration)
+        else:
+            self.aborted += 1
+        while self.queue and self.active < self.limit:
+            self._start(self.queue.popleft())
+
+
+controller = AdmissionController()
+
+def on_startup():
+    controller.configure(_config)
+
+app.startup.connect(on_startup)
@@ -4,28 +4,72 @@ AMP server-side client.
 '''
 
 import functools
+import time
 
 from twisted.protocols import amp
 from twisted.internet import protocol
 from twisted.internet.defer import returnValue, inlineCallbacks
 
-from consys.common import app, network as common_network
+from consys.common import log
+from consys.common import app, metrics, network as common_network
 from consys.common.ampi import admin
 from consys.common.network import AMP_CHANNEL_NAME
-from consys.server import hw, network
+from consys.server import hw, network, events, broadcast, heartbeat
+
+_log = log.getLogger(__name__)
 
 class AmpServerProtocol(amp.AMP):
 
+    def __init__(self, *args, **kwargs):
+        amp.AMP.__init__(self, *args, **kwargs)
+        self._timed_responders = {}
+
     def makeConnection(self, transport):
         amp.AMP.makeConnection(self, transport)
-        hw.new_terminal.connect(self.notify_new_terminal)
-        hw.terminal_removed.connect(self.notify_terminal_removed)
-        hw.terminal_status_updated.connect(self.notify_terminal_status_updated)
+        events.batch_ready.connect(self.notify_events_batch)
+        self.heartbeat = heartbeat.Heartbeat(
+            lambda: self.callRemote(admin.Ping), self.on_dead, self)
+
+    def connectionLost(self, reason):
+        self.heartbeat.stop()
+        events.batch_ready.disconnect(self.notify_events_batch)
+        amp.AMP.connectionLost(self, reason)
+
+    def on_dead(self):
+        _log.warning('Admin missed {0} heartbeats, '
+                     'disconnecting'.format(self.missed_beats))
+        heartbeat.abort_connection(self.transport.conn)
+
+    def locateResponder(self, name):
+        # The timing wrapper is built once per command and connection
+        try:
+            return self._timed_responders[name]
+        except KeyError:
+            pass
+        responder = amp.AMP.locateResponder(self, name)
+        if responder is not None:
+            stats = metrics.registry.stats(b'amp', name)
+            def _timed(box):
+                return stats.observe(time.time(), responder(box))
+            responder = _timed
+        self._timed_responders[name] = responder
+        return responder
 
     @admin.Ping.responder
     def on_ping(self):
         return {}
 
+    @admin.GetMetrics.responder
+    def get_metrics(self):
+        return {b'bounds': metrics.BOUNDS,
+                b'methods': [{b'link': bytes(stats.link),
+                              b'method': bytes(stats.method),
+                              b'calls': stats.calls,
+                              b'errors': stats.errors,
+                              b'total': stats.total,
+                              b'counts': stats.counts}
+                             for stats in metrics.registry.all()]}
+
     @admin.GetTerminals.responder
     def get_terminals(self):
         return {b'ids': hw.manager.terminals.keys()}
@@ -37,7 +81,44 @@ class AmpServerProtocol(amp.AMP):
         except KeyError:
             raise admin.NoSuchObjectError('Terminal {0} not found'.format(id))
         return {b'name': terminal.name.encode('utf-8'),
-                b'online': terminal.is_online()}
+                b'online': terminal.is_online(),
+                b'rtt': _terminal_rtt(terminal)}
+
+    @admin.GetTerminalsSnapshot.responder
+    def get_terminals_snapshot(self, after=None, limit=None):
+        if after is None:
+            # Everything up to the snapshot must be covered by its
+            # sequence number
+            events.batcher.flush()
+        terminals = hw.manager.terminals
+        ids = sorted(id for id in terminals if after is None or id > after)
+        if limit is not None and limit > 0:
+            candidates = ids[:limit]
+        else:
+            candidates = ids
+        page = []
+        size = 0
+        for id in candidates:
+            entry = _terminal_snapshot(terminals[id])
+            size += _box_size(entry)
+            if page and size > amp.MAX_VALUE_LENGTH:
+                break
+            page.append(entry)
+        return {b'terminals': page,
+                b'more': len(page) < len(ids),
+                b'epoch': events.batcher.epoch,
+                b'seq': events.batcher.seq}
+
+    @admin.GetChangesSince.responder
+    def get_changes_since(self, epoch, seq):
+        changes = None
+        if epoch == events.batcher.epoch:
+            changes = events.batcher.changes_since(seq)
+        if changes is None:
+            raise admin.ChangesUnavailableError('Changes since {0}:{1} are '
+                                                'not available'.format(epoch,
+                                                                       seq))
+        return {b'seq': events.batcher.seq, b'events': changes}
 
     @admin.ShutdownTerminal.responder
     def shutdown_terminal(self, id):
@@ -50,18 +131,52 @@ class AmpServerProtocol(amp.AMP):
                                              ' is offline'.format(id))
         @inlineCallbacks
         def _do_shutdown():
-            yield terminal.client.callRemote(b'shutdown')
+            yield terminal.client.mind.callRemote(b'shutdown')
             returnValue({})
         return _do_shutdown()
 
-    def notify_new_terminal(self, id):
-        self.callRemote(admin.NewTerminal, id=id)
-
-    def notify_terminal_removed(self, id):
-        self.callRemote(admin.RemovedTerminal, id=id)
-
-    def notify_terminal_status_updated(self, id, online):
-        self.callRemote(admin.TerminalStatusUpdated, id=id, online=online)
+    @admin.BroadcastTerminals.responder
+    def broadcast_terminals(self, operation, ids=None, selector=None,
+                            workstations=None, concurrency=None):
+        if operation not in broadcast.OPERATIONS:
+            raise admin.UnknownOperationError('Unknown operation '
+                                              '{0}'.format(operation))
+        if ids is not None:
+            terminals = [(id, hw.manager.terminals.get(id)) for id in ids]
+        elif selector == b'all':
+            terminals = hw.manager.terminals.items()
+        elif selector == b'online':
+            terminals = hw.manager.online_terminals().items()
+        elif selector == b'workstations' and workstations is not None:
+            workstations = set(workstations)
+            terminals = [(id, terminal) for id, terminal
+                         in hw.manager.terminals.iteritems()
+                         if getattr(terminal, 'workstation_id', None)
+                         in workstations]
+        else:
+            raise admin.InvalidSelectorError('Invalid terminal selector '
+                                             '{0}'.format(selector))
+        d = broadcast.broadcast(operation, terminals, concurrency)
+        return d.addCallback(lambda results: {b'results': results})
+
+    def notify_events_batch(self, seq, batch):
+        self.callRemote(admin.TerminalEventsBatch, seq=seq, events=batch)
+
+
+def _terminal_snapshot(terminal):
+    return {b'id': terminal.id,
+            b'name': terminal.name.encode('utf-8'),
+            b'online': terminal.is_online(),
+            b'workstation': getattr(terminal, 'workstation_id', None),
+            b'rtt': _terminal_rtt(terminal)}
+
+def _box_size(entry):
+    '''Returns an upper bound of the encoded size of an AmpList entry.'''
+    return 2 + sum(4 + len(key) + len(repr(value))
+                   for key, value in entry.iteritems() if value is not None)
+
+def _terminal_rtt(terminal):
+    return terminal.rtt if terminal.is_online() else None
 
 
 factory = protocol.Factory() 
@@ -0,0 +1,102 @@
+'''
+Concurrent fan-out of RPC calls to many terminals.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import time
+
+from twisted.internet import defer, reactor, error
+from twisted.python.failure import Failure
+from twisted.spread import pb
+
+from consys.common import log
+from consys.common import configuration
+
+__all__ = ['OPERATIONS', 'broadcast']
+
+_config = configuration.register_section('broadcast',
+    {
+        'concurrency': 'integer(min=1, default=64)',
+        'timeout': 'float(min=0, default=10.0)',
+    })
+
+_log = log.getLogger(__name__)
+
+OPERATIONS = {
+    b'lock': b'lock',
+    b'unlock': b'unlock',
+    b'shutdown': b'shutdown',
+}
+'''Supported operations and the client root methods implementing them'''
+
+NO_SUCH_OBJECT = b'NO_SUCH_OBJECT'
+TERMINAL_OFFLINE = b'TERMINAL_OFFLINE'
+ERROR_LENGTH = 200
+'''Longer failure descriptions are truncated in the results'''
+
+
+def broadcast(operation, terminals, concurrency=None):
+    '''
+    Performs the operation on all given terminals, at most concurrency
+    calls at a time. Never fails; the result is a list of dicts with id,
+    success, error (if failed) and latency (in seconds) for every
+    terminal, in the given order.
+    @param terminals: sequence of (id, Terminal or None if there is no
+        terminal with that id)
+    '''
+    method = OPERATIONS[operation]
+    if concurrency is None or concurrency < 1:
+        concurrency = _config['concurrency']
+    semaphore = defer.DeferredSemaphore(concurrency)
+    calls = [semaphore.run(_call, id, terminal, method)
+             for id, terminal in terminals]
+    _log.debug('Broadcasting {0} to {1} terminals'.format(operation,
+                                                          len(calls)))
+    return defer.gatherResults(calls)
+
+def _result(id, started, error=None):
+    result = {b'id': id,
+              b'success': error is None,
+              b'latency': time.time() - started}
+    if error is not None:
+        result[b'error'] = error
+    return result
+
+def _call(id, terminal, method):
+    started = time.time()
+    if terminal is None:
+        return _result(id, started, NO_SUCH_OBJECT)
+    if not terminal.is_online():
+        return _result(id, started, TERMINAL_OFFLINE)
+    # A stale reference fails synchronously
+    d = _timeout(defer.maybeDeferred(terminal.client.mind.callRemote, method),
+                 _config['timeout'])
+    def _cbCall(_):
+        return _result(id, started)
+    def _ebCall(failure):
+        if method == b'shutdown' and failure.check(pb.PBConnectionLost):
+            # The terminal went down before answering
+            return _result(id, started)
+        _log.warning('{0} on terminal {1} failed: {2}'.format(method, id,
+                                                              failure))
+        message = failure.getErrorMessage().encode('utf-8')
+        return _result(id, started, message[:ERROR_LENGTH])
+    return d.addCallbacks(_cbCall, _ebCall)
+
+def _timeout(deferred, timeout):
+    '''Returns a Deferred that fails with TimeoutError if the given one
+    does not fire in time.'''
+    result = defer.Deferred()
+    def _cbTimeout():
+        result.errback(Failure(error.TimeoutError('No answer in '
+                                                  '{0} s'.format(timeout))))
+    timer = reactor.callLater(timeout, _cbTimeout)
+    def _cbDone(value):
+        # A late result is dropped, nobody is waiting for it any more
+        if timer.active():
+            timer.cancel()
+            result.callback(value)
+    deferred.addBoth(_cbDone)
+    return result
@@ -0,0 +1,161 @@
+'''
+Coalescing of hardware events for delivery to admins.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import collections
+import uuid
+
+from notify.all import Signal
+
+from twisted.internet import reactor
+
+from consys.common import log
+from consys.common import configuration, app
+from consys.server import hw
+
+_config = configuration.register_section('server-events',
+    {
+        'batch-interval': 'float(min=0, default=0.1)',
+        'batch-size': 'integer(min=1, default=500)',
+        'journal-size': 'integer(min=0, default=10000)',
+    })
+
+_log = log.getLogger(__name__)
+
+NEW = b'new'
+REMOVED = b'removed'
+STATUS = b'status'
+
+
+class EventBatcher(object):
+    '''
+    Buffers hardware events for a short window and emits them as one
+    sequenced batch. Consecutive status updates of the same terminal are
+    coalesced, so only the latest one is delivered.
+
+    Emitted batches are kept in a bounded journal, so that a reconnecting
+    admin can catch up with the changes it has missed.
+    '''
+    def __init__(self, config=None):
+        self.interval = None
+        self.size = None
+        self.journal_size = None
+        if config is not None:
+            self.configure(config)
+        self.epoch = uuid.uuid4().hex.encode('ascii')
+        '''Identifies this server run, as sequence numbers restart with it'''
+        self.seq = 0
+        self._events = []
+        self._status_index = {}
+        self._timer = None
+        self._journal = collections.deque()
+        self._journal_events = 0
+
+    def configure(self, config):
+        '''Takes the parameters from a [server-events] section.'''
+        self.interval = config['batch-interval']
+        self.size = config['batch-size']
+        self.journal_size = config['journal-size']
+
+    def on_new_terminal(self, id):
+        terminal = hw.manager.terminals[id]
+        self._add(id, {b'kind': NEW, b'id': id,
+                       b'name': terminal.name.encode('utf-8'),
+                       b'online': terminal.is_online()})
+
+    def on_terminal_removed(self, id):
+        self._add(id, {b'kind': REMOVED, b'id': id})
+
+    def on_terminal_status_updated(self, id, online):
+        self._add(id, {b'kind': STATUS, b'id': id, b'online': online})
+
+    def _add(self, id, event):
+        if event[b'kind'] == STATUS:
+            index = self._status_index.get(id)
+            if index is not None:
+                self._events[index] = event
+                return
+            self._status_index[id] = len(self._events)
+        else:
+            self._status_index.pop(id, None)
+        self._events.append(event)
+        if len(self._events) >= self.size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.interval, self.flush)
+
+    def flush(self):
+        '''Emits all buffered events as a single batch right away.'''
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if not self._events:
+            return
+        events = self._events
+        self._events = []
+        self._status_index = {}
+        self.seq += 1
+        self._journal.append((self.seq, events))
+        self._journal_events += len(events)
+        while self._journal and self._journal_events > self.journal_size:
+            _, dropped = self._journal.popleft()
+            self._journal_events -= len(dropped)
+        batch_ready(self.seq, events)
+
+    def changes_since(self, seq):
+        '''
+        Flushes buffered events and returns everything that has happened
+        after the batch with the given sequence number, at most one event
+        per terminal. Returns None if the journal does not reach that far
+        back or the result would not fit into a single batch.
+        '''
+        self.flush()
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self._journal or \
+                self._journal[0][0] > seq + 1:
+            return None
+        changes = collections.OrderedDict()
+        for batch_seq, events in self._journal:
+            if batch_seq <= seq:
+                continue
+            for event in events:
+                id = event[b'id']
+                last = changes.get(id)
+                if event[b'kind'] == STATUS and last is not None and \
+                        last[b'kind'] == NEW:
+                    last[b'online'] = event[b'online']
+                else:
+                    changes[id] = dict(event)
+        if len(changes) > self.size:
+            return None
+        return changes.values()
+
+    def on_shutdown(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+
+batcher = EventBatcher()
+
+def on_startup():
+    batcher.configure(_config)
+
+hw.new_terminal.connect(batcher.on_new_terminal)
+hw.terminal_removed.connect(batcher.on_terminal_removed)
+hw.terminal_status_updated.connect(batcher.on_terminal_status_updated)
+app.startup.connect(on_startup)
+app.shutdown.connect(batcher.on_shutdown)
+
+batch_ready = Signal()
+'''Is called when a batch of hardware events is ready for delivery.
+@param seq: Batch sequence number, increasing by one with every batch
+@type seq: int
+@param events: Events, in the order they have happened
+@type events: list of dicts suitable for admin.TerminalEventsBatch
+'''
@@ -0,0 +1,152 @@
+'''
+Optional HTTP endpoint serving server metrics in the Prometheus text
+format.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import sys
+
+from twistar.registry import Registry
+from twisted.internet import reactor, endpoints
+from twisted.web import resource, server
+
+from consys.common import log
+from consys.common import configuration, app, metrics, lag
+from consys.server import admission, connections, hw
+
+_config = configuration.register_section('metrics-exporter',
+    {
+        'enabled': 'boolean(default=False)',
+        'listen-string': 'string(default=tcp:9122:interface=127.0.0.1)',
+    })
+
+_log = log.getLogger(__name__)
+
+
+def _name(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+class MetricsWriter(object):
+    '''Formats metrics in the Prometheus text exposition format.'''
+
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, kind, help):
+        self.lines.append('# HELP {0} {1}'.format(name, help))
+        self.lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    def metric(self, name, kind, help, value, labels=None):
+        self.header(name, kind, help)
+        self.sample(name, value, labels)
+
+    def sample(self, name, value, labels=None):
+        if labels:
+            name += '{' + ','.join('{0}="{1}"'.format(k, v)
+                                   for k, v in sorted(labels.items())) + '}'
+        self.lines.append('{0} {1}'.format(name, value))
+
+    def histogram(self, name, stats, labels=None):
+        labels = labels or {}
+        seen = 0
+        for bound, count in zip(metrics.BOUNDS, stats.counts):
+            seen += count
+            self.sample(name + '_bucket', seen, dict(labels, le=repr(bound)))
+        self.sample(name + '_bucket', stats.calls, dict(labels, le='+Inf'))
+        self.sample(name + '_sum', stats.total, labels)
+        self.sample(name + '_count', stats.calls, labels)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def collect():
+    '''Returns all metrics as text.'''
+    w = MetricsWriter()
+    w.metric('consys_clients_connected', 'gauge',
+             'Connected client daemons', len(connections.tracker.clients))
+    w.metric('consys_admins_connected', 'gauge',
+             'Connected admin consoles', len(connections.tracker.admins))
+    index = hw.manager.index
+    w.metric('consys_terminals_known', 'gauge', 'Terminals in the database',
+             len(index.online) + len(index.offline))
+    w.metric('consys_terminals_online', 'gauge', 'Terminals online',
+             len(index.online))
+
+    stats = admission.controller.stats()
+    w.metric('consys_handshakes_active', 'gauge',
+             'SSH handshakes in progress', stats['active'])
+    w.metric('consys_handshakes_queued', 'gauge',
+             'Connections waiting for admission', stats['queue-length'])
+    w.header('consys_handshake_seconds', 'summary',
+             'Duration of completed SSH handshakes')
+    w.sample('consys_handshake_seconds_sum', stats['total-handshake-time'])
+    w.sample('consys_handshake_seconds_count', stats['completed'])
+    w.metric('consys_handshakes_aborted_total', 'counter',
+             'Handshakes that have not completed', stats['aborted'])
+    w.metric('consys_handshake_longest_seconds', 'gauge',
+             'Longest completed handshake', stats['longest-handshake'])
+
+    pool = Registry.DBPOOL
+    if pool is not None:
+        w.metric('consys_db_connections', 'gauge',
+                 'Open database connections', len(pool.connections))
+        w.metric('consys_db_busy_threads', 'gauge',
+                 'Database threads running an interaction',
+                 len(pool.threadpool.working))
+        w.metric('consys_db_queued', 'gauge',
+                 'Database interactions waiting for a thread',
+                 pool.threadpool.q.qsize())
+    # Importing the scheduler would start its thread pool, it is only
+    # reported if something else uses it
+    scheduler = sys.modules.get('consys.common.scheduler')
+    if scheduler is not None:
+        w.metric('consys_scheduler_queue_length', 'gauge',
+                 'Tasks waiting in the scheduler thread pool',
+                 scheduler.pool.getQueueLength())
+
+    w.metric('consys_reactor_lag_seconds', 'gauge',
+             'Last measured reactor lag', lag.monitor.last)
+    w.metric('consys_reactor_lag_max_seconds', 'gauge',
+             'Maximum reactor lag since the previous scrape',
+             lag.monitor.take_max())
+    w.header('consys_reactor_lag_histogram_seconds', 'histogram',
+             'Reactor lag samples')
+    w.histogram('consys_reactor_lag_histogram_seconds', lag.monitor.stats)
+
+    methods = metrics.registry.all()
+    w.header('consys_rpc_seconds', 'histogram', 'RPC call latency')
+    for method in methods:
+        w.histogram('consys_rpc_seconds', method,
+                    {'link': _name(method.link),
+                     'method': _name(method.method)})
+    w.header('consys_rpc_errors_total', 'counter', 'Failed RPC calls')
+    for method in methods:
+        w.sample('consys_rpc_errors_total', method.errors,
+                 {'link': _name(method.link), 'method': _name(method.method)})
+    return w.text()
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return collect().encode('utf-8')
+
+
+def on_startup():
+    if not _config['enabled']:
+        return
+    endpoint = endpoints.serverFromString(reactor,
+          _config['listen-string'].encode('utf-8'))
+    d = endpoint.listen(server.Site(MetricsResource()))
+    d.addCallbacks(
+        lambda port: _log.info('Serving metrics on {0}'.format(
+            port.getHost())),
+        lambda failure: _log.error('Cannot serve metrics: {0}'.format(
+            failure.getErrorMessage())))
+
+app.startup.connect(on_startup)
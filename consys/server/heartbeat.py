@@ -0,0 +1,122 @@
+'''
+Server-driven heartbeats of terminal and admin connections.
+@author: Nikita Ofitserov
+'''
+
+from __future__ import unicode_literals
+
+import random
+
+from twisted.internet import reactor, defer, task
+
+from consys.common import log
+from consys.common import configuration, app
+from consys.server import hw
+
+_config = configuration.register_section('heartbeat',
+    {
+        'interval': 'float(min=0.1, default=5)',
+        # Must not exceed the interval, a longer one is cut down to it
+        'timeout': 'float(min=0.1, default=3)',
+        'max-missed': 'integer(min=1, default=3)',
+        # Weight of the last sample in the round trip time average
+        'rtt-weight': 'float(min=0, max=1, default=0.2)',
+    })
+
+_log = log.getLogger(__name__)
+
+
+class Heartbeat(object):
+    '''
+    Pings a peer every interval seconds, starting at a random phase so
+    that heartbeats of many connections are spread over the interval.
+    Keeps an exponentially weighted round trip time and the number of
+    beats missed in a row in the rtt and missed_beats attributes of
+    stats, and calls dead() once max_missed beats have been missed.
+    '''
+
+    def __init__(self, ping, dead, stats):
+        self.ping = ping
+        self.dead = dead
+        self.stats = stats
+        self.interval = _config['interval']
+        self.timeout = _timeout()
+        self.max_missed = _config['max-missed']
+        self.weight = _config['rtt-weight']
+        stats.rtt = None
+        stats.missed_beats = 0
+        self._loop = task.LoopingCall(self._beat)
+        self._start = reactor.callLater(random.uniform(0, self.interval),
+                                        self._loop.start, self.interval)
+
+    def stop(self):
+        if self._start.active():
+            self._start.cancel()
+        if self._loop.running:
+            self._loop.stop()
+
+    def _beat(self):
+        sent = reactor.seconds()
+        timer = reactor.callLater(self.timeout, self._missed)
+        d = defer.maybeDeferred(self.ping)
+        d.addCallbacks(self._cbPong, self._ebPong,
+                       callbackArgs=(sent, timer), errbackArgs=(timer,))
+
+    def _cbPong(self, _, sent, timer):
+        if not timer.active():
+            # Too late, already counted as missed
+            return
+        timer.cancel()
+        rtt = reactor.seconds() - sent
+        if self.stats.rtt is None:
+            self.stats.rtt = rtt
+        else:
+            self.stats.rtt += self.weight * (rtt - self.stats.rtt)
+        self.stats.missed_beats = 0
+
+    def _ebPong(self, failure, timer):
+        if timer.active():
+            timer.cancel()
+            _log.debug('Heartbeat of {0} failed: {1}'.format(
+                self.stats, failure.getErrorMessage()))
+            self._missed()
+
+    def _missed(self):
+        self.stats.missed_beats += 1
+        if self.stats.missed_beats == self.max_missed:
+            self.stop()
+            self.dead()
+
+
+def _timeout():
+    # A longer timeout would let pings overlap and beats be counted as
+    # missed out of order
+    return min(_config['timeout'], _config['interval'])
+
+def abort_connection(conn):
+    '''Drops an SSH connection without waiting for the peer.'''
+    conn.transport.transport.abortConnection()
+
+_terminal_hearts = {}
+
+def on_terminal_status_updated(id, online):
+    terminal = hw.manager.terminals[id]
+    if online:
+        client = terminal.client
+        def _dead():
+            _log.warning('Terminal {0} missed {1} heartbeats, '
+                         'disconnecting'.format(id, terminal.missed_beats))
+            abort_connection(client.conn)
+        _terminal_hearts[id] = Heartbeat(
+            lambda: client.mind.callRemote(b'ping'), _dead, terminal)
+    elif id in _terminal_hearts:
+        _terminal_hearts.pop(id).stop()
+
+def on_startup():
+    if _config['timeout'] > _config['interval']:
+        _log.warning('Heartbeat timeout {0} exceeds the interval {1}, '
+                     'using the interval'.format(_config['timeout'],
+                                                 _config['interval']))
+
+hw.terminal_status_updated.connect(on_terminal_status_updated)
+app.startup.connect(on_startup)
@@ -6,6 +6,8 @@ Contest hardware management
 from __future__ import unicode_literals
 
 
+import logging
+
 from notify.signal import Signal
 
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -20,6 +22,49 @@ class StateError(Exception):
     Indicates that a transition while in an illegal hardware state was requested.
     '''
 
+class TerminalIndex(object):
+    '''
+    Keeps terminals indexed by connection state and by client avatar, so
+    that lookups do not have to walk over all terminals.
+    '''
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.online = {}
+        '''Online terminals by id'''
+        self.offline = {}
+        '''Offline terminals by id'''
+        self.by_avatar = {}
+        '''Online terminals by client avatar'''
+
+    def add(self, terminal):
+        if terminal.is_online():
+            self.online[terminal.id] = terminal
+            self.by_avatar[terminal.client] = terminal
+        else:
+            self.offline[terminal.id] = terminal
+
+    def remove(self, terminal):
+        if terminal.is_online():
+            del self.online[terminal.id]
+            del self.by_avatar[terminal.client]
+        else:
+            del self.offline[terminal.id]
+
+    def connected(self, terminal):
+        del self.offline[terminal.id]
+        self.online[terminal.id] = terminal
+        self.by_avatar[terminal.client] = terminal
+
+    def disconnected(self, terminal, client):
+        del self.online[terminal.id]
+        del self.by_avatar[client]
+        self.offline[terminal.id] = terminal
+
+_index = TerminalIndex()
+
+
 class Terminal(persistent.Base):
     '''
     Represents a contest terminal (computer capable of being a workstation).
@@ -35,6 +80,10 @@ class Terminal(persistent.Base):
     def __init__(self, **kwargs):
         persistent.Base.__init__(self, **kwargs)
         self.client = None
+        self.rtt = None
+        '''Average round trip time in seconds, None if not measured'''
+        self.missed_beats = 0
+        '''Heartbeats missed in a row'''
     
     def __repr__(self):
         return '<Terminal(id: {0}, {1}'\
@@ -46,12 +95,15 @@ class Terminal(persistent.Base):
                                                                        self))
         self.client = client
         client.terminalId = self.id
+        _index.connected(self)
     
     def disconnect(self):
         if not self.is_online():
             raise StateError('Terminal {0} cannot be disconnected'.format(self))
-        self.client.terminalId = None
+        client = self.client
+        client.terminalId = None
         self.client = None
+        _index.disconnected(self, client)
     
     def is_online(self):
         return self.client is not None
@@ -81,17 +133,25 @@ class Manager(object):
     Manages all hardware, keeping track of network events.
     '''
     def __init__(self):
+        self.index = _index
+        self.terminal_ids = persistent.IdAllocator(Terminal.TABLENAME)
         persistent.ready.connect(self.on_db_ready)
         network.client_connected.connect(self.on_client_connection)
         network.client_disconnected.connect(self.on_client_disconnect)
 
     @inlineCallbacks
     def create_terminal(self):
-        freeid = max(self.terminals.keys() + [0]) + 1
-        terminal = Terminal(name='PC#{0}'.format(freeid))
-        terminal = yield terminal.save()
-        self.terminals[terminal.id] = terminal
-        _log.debug('Created terminal {0}'.format(terminal.id))
+        id = yield self.terminal_ids.allocate()
+        terminal = Terminal(id=id, name='PC#{0}'.format(id))
+        self.terminals[id] = terminal
+        self.index.add(terminal)
+        try:
+            yield persistent.write_behind.insert(terminal)
+        except Exception:
+            del self.terminals[id]
+            self.index.remove(terminal)
+            raise
+        _log.debug('Created terminal %d', terminal.id)
         new_terminal(terminal.id)
         returnValue(terminal)
 
@@ -100,7 +160,7 @@ class Manager(object):
         workstation = Workstation(name=name)
         workstation = yield workstation.save()
         self.workstations[workstation.id] = workstation
-        _log.debug('Created workstation {0}'.format(workstation.id))
+        _log.debug('Created workstation %d', workstation.id)
         new_workstation(workstation.id)
         returnValue(workstation)
 
@@ -113,16 +173,27 @@ class Manager(object):
         else:
             terminal = self.terminals[terminal_id]
         terminal.connect(avatar)
-        terminal_status_updated(terminal_id, True)
-        _log.debug('Updated terminal status: {0}'.format(repr(terminal)))
+        terminal_status_updated(terminal.id, True)
+        _log.debug('Terminal %d is online', terminal.id)
     
     def on_client_disconnect(self, avatar):
-        for terminal in self.terminals.values():
-            if terminal.client == avatar:
-                terminal.disconnect()
-                _log.debug('Updated terminal status:'
-                           ' {0}'.format(repr(terminal)))
-                terminal_status_updated(terminal.id, False)
+        terminal = self.index.by_avatar.get(avatar)
+        if terminal is not None:
+            terminal.disconnect()
+            _log.debug('Terminal %d is offline', terminal.id)
+            terminal_status_updated(terminal.id, False)
+
+    def terminal_by_avatar(self, avatar):
+        '''Returns the terminal the avatar is connected as, or None.'''
+        return self.index.by_avatar.get(avatar)
+
+    def online_terminals(self):
+        '''Returns a dict of online terminals by id. Do not modify it.'''
+        return self.index.online
+
+    def offline_terminals(self):
+        '''Returns a dict of offline terminals by id. Do not modify it.'''
+        return self.index.offline
     
     @inlineCallbacks
     def on_db_ready(self):
@@ -130,13 +201,17 @@ class Manager(object):
             return dict(map(lambda e: (e.id, e), ls))
         ts = yield Terminal.all()
         self.terminals = dictify(ts)
-        _log.info('Loaded {0} terminals from DB'.format(len(self.terminals)))
-        _log.debug('Terminals: {0}'.format(self.terminals))
+        self.index.clear()
+        for terminal in ts:
+            self.index.add(terminal)
+        _log.info('Loaded %d terminals from DB', len(self.terminals))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('Terminals: %s', sorted(self.terminals))
         ws = yield Workstation.all()
         self.workstations = dictify(ws)
-        _log.info('Loaded {0} workstations from '
-                  'DB'.format(len(self.workstations)))
-        _log.debug('Workstations: {0}'.format(self.workstations))
+        _log.info('Loaded %d workstations from DB', len(self.workstations))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('Workstations: %s', sorted(self.workstations))
 
 
 persistent.register_classes(Terminal, Workstation)
@@ -8,15 +8,18 @@ from __future__ import unicode_literals
 import base64
 import hashlib
 import functools
+import os
+import resource
 
 from zope.interface import implements
 from notify.all import Signal
-from twisted.conch import avatar
+from twisted.conch import avatar, error
 from twisted.conch.checkers import SSHPublicKeyDatabase
 from twisted.conch.insults import insults
 from twisted.conch.manhole import ColoredManhole
 from twisted.conch.manhole_ssh import TerminalSession
-from twisted.conch.ssh import session, keys, factory, userauth, connection
+from twisted.conch.ssh import session, factory, userauth, connection, \
+    transport
 from twisted.cred import portal
 from twisted.cred.checkers import FilePasswordDB
 from twisted.internet import reactor, protocol, endpoints
@@ -24,7 +27,9 @@ from twisted.python import components
 from twisted.spread import pb
 
 from consys.common import log
-from consys.common import configuration, network, app
+from consys.common import configuration, network, app, keycache, metrics, \
+    lag
+from consys.server import admission
 
 __all__ = ['on_startup', 'client_connected', 'client_disconnected']
 
@@ -40,7 +45,6 @@ _config = configuration.register_section('network',
 _log = log.getLogger(__name__)
 
 class ClientAvatar(avatar.ConchUser, pb.Root):
-    CONNECT_DELAY = 0.25
 
     def __init__(self):
         avatar.ConchUser.__init__(self)
@@ -52,7 +56,8 @@ class ClientAvatar(avatar.ConchUser, pb.Root):
         return '<ClientAvatar(terminalID: {0})>'.format(self.terminalId)
 
     def loggedIn(self):
-        self.timer = reactor.callLater(self.CONNECT_DELAY, self.on_timeout)
+        self.timer = reactor.callLater(admission.controller.deadline(),
+                                       self.on_timeout)
         channel = network.RpcChannel(factory=self.rpcFactory)
         self.conn.openChannel(channel)
 
@@ -62,7 +67,8 @@ class ClientAvatar(avatar.ConchUser, pb.Root):
 
     def remote_set_mind(self, mind):
         self.timer.cancel()
-        self.mind = mind
+        self.conn.transport.handshakeFinished()
+        self.mind = metrics.InstrumentedReference(mind)
         client_connected(self)
         self.connected = True
         _log.info('RPC connection ready')    
@@ -81,6 +87,9 @@ class AdminAvatar(avatar.ConchUser, pb.Root):
         self.namespace = {
                           'self': self,
                           'reactor': reactor,
+                          'admission': admission.controller,
+                          'metrics': metrics.registry,
+                          'lag': lag.monitor,
                           }
         self.register_channel('session', session.SSHSession)
 
@@ -88,6 +97,7 @@ class AdminAvatar(avatar.ConchUser, pb.Root):
         self.channelLookup[name] = factory
 
     def loggedIn(self):
+        self.conn.transport.handshakeFinished()
         admin_connected(self)
     
     def loggedOut(self):
@@ -164,14 +174,15 @@ class ExampleRealm:
 
 
 class InMemoryPublicKeyChecker(SSHPublicKeyDatabase):
+    '''Accepts a single user with the public key from the given file.'''
 
-    def __init__(self, username, publickey):
+    def __init__(self, username, keyfile):
         self.username = username
-        self.publickey = publickey
+        self.keyfile = keyfile
 
     def checkKey(self, credentials):
         return credentials.username == self.username and \
-            self.publickey.blob() == credentials.blob
+            keycache.get_public_blob(self.keyfile) == credentials.blob
 
 
 class SSHConnection(connection.SSHConnection):
@@ -186,38 +197,137 @@ class SSHConnection(connection.SSHConnection):
         connection.SSHConnection.serviceStopped(self)
         
 
+class SSHServerTransport(transport.SSHServerTransport):
+    '''
+    A server SSH transport which goes through admission control: the
+    handshake starts only when admitted, and the slot is held until the
+    avatar reports that the handshake is finished.
+    '''
+
+    def connectionMade(self):
+        self.paused = False
+        self.timer = None
+        self.handshake = admission.controller.request(self._cbAdmitted)
+        if not self.handshake.started:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def _cbAdmitted(self):
+        if self.paused:
+            self.paused = False
+            self.transport.resumeProducing()
+        self.timer = reactor.callLater(admission.controller.max_time,
+                                       self._cbTimeout)
+        transport.SSHServerTransport.connectionMade(self)
+
+    def _cbTimeout(self):
+        self.timer = None
+        _log.warning('Handshake with {0} takes too long, '
+                     'dropping'.format(self.transport.getPeer()))
+        self.transport.loseConnection()
+
+    def handshakeFinished(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.handshake.finish()
+
+    def connectionLost(self, reason):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.handshake.cancel()
+        transport.SSHServerTransport.connectionLost(self, reason)
+
+
 class SSHServerFactory(factory.SSHFactory):
-    publicKeys = {
-        b'ssh-rsa': keys.Key.fromFile(_config['server-key']).public()
-    }
-    privateKeys = {
-        b'ssh-rsa': keys.Key.fromFile(_config['server-key'])
-    }
+    '''
+    SSH server factory which parses the host keys and sets up the portal
+    on first use rather than when it starts listening.
+    '''
+    protocol = SSHServerTransport
     services = {
         b'ssh-userauth': userauth.SSHUserAuthServer,
         b'ssh-connection': SSHConnection
     }
 
+    def startFactory(self):
+        # What SSHFactory.startFactory does, except for loading the keys:
+        # keep the private host key out of core dumps, and fail now if
+        # there is no host key
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        if not os.access(_config['server-key'], os.R_OK):
+            raise error.ConchError('no host keys, failing')
+        self.primes = self.getPrimes()
+
+    @property
+    def publicKeys(self):
+        return {b'ssh-rsa': keycache.get_public_key(_config['server-key'])}
+
+    @property
+    def privateKeys(self):
+        return {b'ssh-rsa': keycache.get_key(_config['server-key'])}
+
+    @property
+    def portal(self):
+        return get_portal()
+
 def _htpasswd_hash(username, password, hashedpassword):
     if hashedpassword.startswith('{SHA}'):
         return '{SHA}' + base64.b64encode(hashlib.sha1(password).digest())
     else:
         return 'bad-hash-algorithm'
 
-_portal = portal.Portal(ExampleRealm())
-_portal.registerChecker(FilePasswordDB(_config['user-auth-db'],
-                                      hash=_htpasswd_hash, cache=True))
-_portal.registerChecker(
-    InMemoryPublicKeyChecker(_config['client-user-name'],
-                             keys.Key.fromFile(_config['client-public-key'])))
-SSHServerFactory.portal = _portal
+_portal = None
+
+def get_portal():
+    '''Returns the portal, creating it on first use.'''
+    global _portal
+    if _portal is None:
+        _portal = portal.Portal(ExampleRealm())
+        _portal.registerChecker(FilePasswordDB(_config['user-auth-db'],
+                                               hash=_htpasswd_hash,
+                                               cache=True))
+        _portal.registerChecker(
+            InMemoryPublicKeyChecker(_config['client-user-name'],
+                                     _config['client-public-key']))
+    return _portal
+
+_factory = SSHServerFactory()
+_port = None
+
+def listen():
+    '''Starts listening on the configured endpoint. When listening, stops
+    listening on the previous one; connections made through it stay.'''
+    old_port = _port
+    endpoint = endpoints.serverFromString(reactor,
+          _config['listen-string'].encode('utf-8'))
+    def _cbListening(port):
+        global _port
+        _port = port
+        _log.info('Listening on {0}'.format(port.getHost()))
+        if old_port is not None:
+            return old_port.stopListening()
+    def _ebListening(failure):
+        _log.error('Cannot listen on {0}: {1}'.format(
+            _config['listen-string'], failure.getErrorMessage()))
+    return endpoint.listen(_factory).addCallbacks(_cbListening,
+                                                  _ebListening)
 
 def on_startup():
-    endpoint = endpoints.serverFromString(reactor, 
-          _config['listen-string'].encode('utf-8'))
-    endpoint.listen(SSHServerFactory())
+    listen()
+
+def on_reload(changes):
+    global _portal
+    if 'listen-string' in changes:
+        listen()
+    if any(key in changes for key in ('user-auth-db', 'client-user-name',
+                                      'client-public-key')):
+        # Created again on the next login
+        _portal = None
 
 app.startup.connect(on_startup)
+configuration.register_reload_handler(on_reload, 'network')
 
 client_connected = Signal()
 ''' Is emitted when a client connects.
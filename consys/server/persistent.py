@@ -5,6 +5,12 @@ Persistent storage support. Based on Twistar/SQLite3.
 
 from __future__ import unicode_literals
 
+import collections
+import os
+import os.path
+import sqlite3
+import threading
+import time
 from urlparse import urlparse
 
 from notify.all import Signal
@@ -13,6 +19,7 @@ from twistar.dbobject import DBObject
 from twistar.dbconfig.base import InteractionBase
 
 from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor, task
 
 from consys.common import log
 from consys.common import configuration, app
@@ -20,19 +27,211 @@ from consys.common import configuration, app
 _config = configuration.register_section('server-persistence', 
     {
         'db-url': 'string(default=sqlite:///data/server.db)',
+        'id-block-size': 'integer(min=1, default=64)',
+        'flush-interval': 'float(min=0, default=0.05)',
+        'flush-size': 'integer(min=1, default=256)',
+        'journal-mode': 'option(wal, delete, truncate, persist, memory, '
+                        'default=wal)',
+        'synchronous': 'option(off, normal, full, default=normal)',
+        # Negative values are in KiB, positive ones in pages
+        'cache-size': 'integer(default=-16384)',
+        'mmap-size': 'integer(min=0, default=268435456)',
+        # SQLite has a single writer: more connections only add lock waits
+        'pool-size': 'integer(min=1, default=1)',
+        'statement-cache': 'integer(min=0, default=256)',
+        'busy-timeout': 'float(min=0, default=5)',
+        'log-queries': 'boolean(default=False)',
+        # Only used with sqlite+memory:/// urls
+        'checkpoint-interval': 'float(min=1, default=60)',
     })
 
 _log = log.getLogger(__name__)
 
+def _sqlite_pragmas():
+    return [
+        'PRAGMA journal_mode = {0}'.format(_config['journal-mode']),
+        'PRAGMA synchronous = {0}'.format(_config['synchronous']),
+        'PRAGMA cache_size = {0}'.format(_config['cache-size']),
+        'PRAGMA mmap_size = {0}'.format(_config['mmap-size']),
+        ]
+
+def _open_sqlite(connection):
+    '''Applies the configured performance profile to a new connection.'''
+    cursor = connection.cursor()
+    try:
+        for pragma in _sqlite_pragmas():
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+class SQLitePool(adbapi.ConnectionPool):
+    '''
+    Connection pool which re-applies the SQLite profile to a connection
+    when it is next used after the profile has changed (see reprofile()),
+    in the connection's own thread.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        adbapi.ConnectionPool.__init__(self, *args, **kwargs)
+        self.generation = 0
+        self._generations = {}
+
+    def reprofile(self):
+        self.generation += 1
+
+    def connect(self):
+        tid = self.threadID()
+        fresh = self.connections.get(tid) is None
+        connection = adbapi.ConnectionPool.connect(self)
+        if not fresh and self._generations.get(tid) != self.generation:
+            _open_sqlite(connection)
+        self._generations[tid] = self.generation
+        return connection
+
 def _handle_sqlite(parsed_url):
     return ('sqlite3', {
+            'pool-class': SQLitePool,
             'database': parsed_url.path[1:],
             'check_same_thread': False,
+            'timeout': _config['busy-timeout'],
+            'cached_statements': _config['statement-cache'],
+            'cp_min': 1,
+            'cp_max': _config['pool-size'],
+            'cp_openfun': _open_sqlite,
             })
 
-_drivers = {'sqlite': _handle_sqlite}
+def _schema(cursor, database='main'):
+    '''Returns (table names, CREATE statements) of a database, tables
+    first.'''
+    cursor.execute("SELECT type, name, sql FROM {0}.sqlite_master "
+                   "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                   "ORDER BY type = 'table' DESC".format(database))
+    rows = cursor.fetchall()
+    return ([name for type, name, sql in rows if type == 'table'],
+            [sql for type, name, sql in rows])
+
+def _copy_database(connection, path, load):
+    '''Copies the whole database between the connection and the file at
+    path, into the connection if load is true and into the file otherwise.
+    The target must have no tables. Uses the online backup API where
+    available (Python 3.7+) and ATTACH otherwise.'''
+    other = sqlite3.connect(path)
+    try:
+        if hasattr(connection, 'backup'):
+            if load:
+                other.backup(connection)
+            else:
+                connection.backup(other)
+            return
+        source = other if load else connection
+        target = connection if load else other
+        tables, statements = _schema(source.cursor())
+        for sql in statements:
+            target.execute(sql)
+        target.commit()
+        other.close()
+        other = None
+        connection.commit()
+        connection.execute('ATTACH DATABASE ? AS disk', (path,))
+        try:
+            for table in tables:
+                if load:
+                    query = 'INSERT INTO main.{0} SELECT * FROM disk.{0}'
+                else:
+                    query = 'INSERT INTO disk.{0} SELECT * FROM main.{0}'
+                connection.execute(query.format(table))
+            connection.commit()
+        finally:
+            connection.execute('DETACH DATABASE disk')
+    finally:
+        if other is not None:
+            other.close()
+
+
+class MemoryCheckpointer(object):
+    '''
+    Keeps an in-memory database in sync with its on-disk copy: loads it
+    when the connection is opened, and writes it back periodically and at
+    shutdown. A checkpoint goes to a temporary file which then replaces
+    the database file, so the file on disk is always consistent.
+    '''
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._loop = None
+
+    def load(self, connection):
+        if os.path.exists(self.path):
+            started = time.time()
+            _copy_database(connection, self.path, True)
+            _log.info('Loaded {0} into memory in {1:.3f}s'.format(self.path,
+                time.time() - started))
+        else:
+            _log.warning('{0} does not exist, starting with an empty '
+                         'in-memory database'.format(self.path))
+
+    def start(self):
+        self._loop = task.LoopingCall(self.checkpoint)
+        self._loop.start(self.interval, now=False).addErrback(
+            lambda failure: _log.error('Checkpointing stopped: {0}'.format(
+                failure)))
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def checkpoint(self):
+        '''Writes the database to disk, returns a Deferred.'''
+        d = Registry.DBPOOL.runWithConnection(self._write)
+        d.addErrback(lambda failure: _log.error(
+            'Checkpoint of {0} failed: {1}'.format(self.path, failure)))
+        return d
+
+    def checkpoint_sync(self):
+        '''Writes the database to disk, blocking until it is done.'''
+        success, result = _run_blocking(Registry.DBPOOL._runWithConnection,
+                                        self._write)
+        if not success:
+            _log.error('Checkpoint of {0} failed: {1}'.format(self.path,
+                                                              result))
 
-Base = DBObject
+    def _write(self, connection):
+        started = time.time()
+        temp_path = self.path + '.checkpoint'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        _copy_database(connection, temp_path, False)
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.path)
+        _log.debug('Checkpointed {0} in {1:.3f}s'.format(self.path,
+            time.time() - started))
+
+_checkpointer = None
+'''MemoryCheckpointer of the in-memory database, if it is used'''
+
+def _handle_sqlite_memory(parsed_url):
+    # A private :memory: database lives in one connection, so the pool
+    # has exactly one.
+    global _checkpointer
+    _checkpointer = MemoryCheckpointer(parsed_url.path[1:],
+                                       _config['checkpoint-interval'])
+    return ('sqlite3', {
+            'database': ':memory:',
+            'check_same_thread': False,
+            'cached_statements': _config['statement-cache'],
+            'cp_min': 1,
+            'cp_max': 1,
+            'cp_reconnect': False,
+            'cp_openfun': _checkpointer.load,
+            })
+
+_drivers = {
+    'sqlite': _handle_sqlite,
+    'sqlite+memory': _handle_sqlite_memory,
+    }
 
 ready = Signal()
 '''Is emitted when the database becomes available'''
@@ -40,11 +239,343 @@ ready = Signal()
 def register_classes(*args):
     Registry.register(*args)
 
-def _on_startup():
-    parsed_url = urlparse(_config['db-url'])
+
+class IdAllocator(object):
+    '''
+    Hands out ids for new rows of a table. Ids are reserved from the
+    database in blocks, one transaction per block, and then given out
+    from memory, so two new objects never get the same id.
+    '''
+
+    def __init__(self, tablename, block_size=None):
+        self.tablename = tablename
+        self.block_size = block_size
+        '''Ids reserved at once, [server-persistence] id-block-size if
+        None'''
+        self._next = 0
+        self._end = 0
+        self._waiting = []
+        self._reserving = False
+
+    def allocate(self):
+        '''Returns a Deferred firing with a fresh id.'''
+        if self._next < self._end:
+            id = self._next
+            self._next += 1
+            return defer.succeed(id)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if not self._reserving:
+            self._reserve()
+        return d
+
+    def _reserve(self):
+        self._reserving = True
+        size = max(self.block_size or _config['id-block-size'],
+                   len(self._waiting))
+        d = Registry.DBPOOL.runInteraction(self._txnReserve, size)
+        d.addCallbacks(self._cbReserved, self._ebReserved)
+
+    def _txnReserve(self, txn, size):
+        txn.execute('CREATE TABLE IF NOT EXISTS id_blocks ('
+                    'tablename TEXT PRIMARY KEY, next_id INTEGER NOT NULL)')
+        txn.execute('SELECT MAX(id) FROM {0}'.format(self.tablename))
+        start = (txn.fetchone()[0] or 0) + 1
+        txn.execute('SELECT next_id FROM id_blocks WHERE tablename = ?',
+                    (self.tablename,))
+        row = txn.fetchone()
+        if row is not None:
+            start = max(start, row[0])
+        txn.execute('INSERT OR REPLACE INTO id_blocks (tablename, next_id) '
+                    'VALUES (?, ?)', (self.tablename, start + size))
+        return start, start + size
+
+    def _cbReserved(self, block):
+        self._reserving = False
+        self._next, self._end = block
+        _log.debug('Reserved ids {0}..{1} for {2}'.format(self._next,
+                                                          self._end - 1,
+                                                          self.tablename))
+        waiting = self._waiting
+        self._waiting = []
+        for d in waiting:
+            if self._next < self._end:
+                id = self._next
+                self._next += 1
+                d.callback(id)
+            else:
+                self._waiting.append(d)
+        if self._waiting and not self._reserving:
+            self._reserve()
+
+    def _ebReserved(self, failure):
+        self._reserving = False
+        _log.error('Cannot reserve ids for {0}: {1}'.format(self.tablename,
+                                                           failure))
+        waiting = self._waiting
+        self._waiting = []
+        for d in waiting:
+            d.errback(failure)
+
+
+class WriteBehindQueue(object):
+    '''
+    Collects pending inserts and updates of DBObjects and writes them in a
+    single transaction, either after the flush interval or as soon as the
+    flush size is reached. Repeated saves of a pending object are written
+    once. A new object saved again while its INSERT is being written is
+    updated once the INSERT has stored the row. Every caller gets a
+    Deferred that fires when its row is stored.
+    '''
+
+    CREATE = 'create'
+    INSERT = 'insert'
+    UPDATE = 'update'
+
+    def __init__(self, config=None):
+        self.interval = None
+        self.size = None
+        if config is not None:
+            self.configure(config)
+        self._pending = collections.OrderedDict()
+        self._creating = {}
+        '''Saves waiting for an INSERT being written, by id() of object'''
+        self._timer = None
+
+    def configure(self, config):
+        '''Takes the parameters from a [server-persistence] section.'''
+        self.interval = config['flush-interval']
+        self.size = config['flush-size']
+
+    def creating(self, obj):
+        '''Returns True if the object's INSERT is being written.'''
+        return id(obj) in self._creating
+
+    def save(self, obj):
+        '''Inserts the object if it has no id yet, updates it otherwise.
+        Returns a Deferred firing with the object once it is stored.'''
+        d = defer.Deferred()
+        key = id(obj)
+        if key in self._creating:
+            # The row id is not known yet, update the row once it is
+            self._creating[key].append(d)
+        else:
+            self._queue(obj, self._mode(obj), [d])
+        return d
+
+    def insert(self, obj):
+        '''Inserts an object with a preassigned id.
+        Returns a Deferred firing with the object once it is stored.'''
+        d = defer.Deferred()
+        self._queue(obj, self.INSERT, [d])
+        return d
+
+    def _mode(self, obj):
+        return self.CREATE if obj.id is None else self.UPDATE
+
+    def _queue(self, obj, mode, deferreds):
+        key = id(obj)
+        if key in self._pending:
+            # Whatever it was, the row will get the current values
+            self._pending[key][2].extend(deferreds)
+        else:
+            self._pending[key] = (obj, mode, deferreds)
+        if len(self._pending) >= self.size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.interval, self.flush)
+
+    def _take(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        items = self._pending.values()
+        self._pending = collections.OrderedDict()
+        for obj, mode, _ in items:
+            if mode in (self.CREATE, self.INSERT):
+                self._creating[id(obj)] = []
+        # Take the values now, objects may change while the write runs
+        rows = [(mode, obj.__class__.tablename(), dict(vars(obj)))
+                for obj, mode, _ in items]
+        return items, rows
+
+    def flush(self):
+        '''Starts writing all pending objects.'''
+        items, rows = self._take()
+        if not items:
+            return
+        d = Registry.DBPOOL.runInteraction(self._txnWrite, rows)
+        d.addCallbacks(self._cbWritten, self._ebWritten,
+                       callbackArgs=(items,), errbackArgs=(items,))
+
+    def flush_sync(self):
+        '''Writes all pending objects, blocking until they are stored.'''
+        # Saves made during an INSERT are queued when it is written
+        while self._pending:
+            items, rows = self._take()
+            _log.info('Flushing {0} pending objects'.format(len(items)))
+            success, result = _run_blocking(Registry.DBPOOL._runInteraction,
+                                            self._txnWrite, rows)
+            if success:
+                self._cbWritten(result, items)
+            else:
+                self._ebWritten(result, items)
+
+    def _cbWritten(self, ids, items):
+        for (obj, mode, deferreds), id in zip(items, ids):
+            if mode == self.CREATE:
+                obj.id = id
+            for d in deferreds:
+                d.callback(obj)
+        self._requeue(items, True)
+
+    def _ebWritten(self, failure, items):
+        _log.error('Cannot write {0} objects: {1}'.format(len(items),
+                                                         failure))
+        for obj, mode, deferreds in items:
+            for d in deferreds:
+                d.errback(failure)
+        self._requeue(items, False)
+
+    def _requeue(self, items, stored):
+        '''Queues the saves made while the items' INSERTs were written.
+        Those of a failed INSERT have to insert the row themselves.'''
+        for obj, mode, _ in items:
+            if mode in (self.CREATE, self.INSERT):
+                deferreds = self._creating.pop(id(obj))
+                if not deferreds:
+                    continue
+                if mode == self.INSERT and not stored:
+                    self._queue(obj, self.INSERT, deferreds)
+                else:
+                    self._queue(obj, self._mode(obj), deferreds)
+
+    def _txnWrite(self, txn, rows):
+        '''Writes the rows, returns ids of the created ones.'''
+        config = Registry.getConfig()
+        ids = [None] * len(rows)
+        batches = collections.OrderedDict()
+        for index, (mode, tablename, values) in enumerate(rows):
+            columns = config.getSchema(tablename, txn)
+            if mode == self.CREATE:
+                columns = [c for c in columns if c != 'id']
+                txn.execute(_insert_query(tablename, columns),
+                            [values.get(c) for c in columns])
+                ids[index] = txn.lastrowid
+            elif mode == self.INSERT:
+                batches.setdefault((tablename, mode), []).append(
+                    [values.get(c) for c in columns])
+            else:
+                columns = [c for c in columns if c != 'id']
+                batches.setdefault((tablename, mode), []).append(
+                    [values.get(c) for c in columns] + [values['id']])
+        for (tablename, mode), params in batches.iteritems():
+            columns = config.getSchema(tablename, txn)
+            if mode == self.INSERT:
+                query = _insert_query(tablename, columns)
+            else:
+                query = 'UPDATE {0} SET {1} WHERE id = ?'.format(tablename,
+                    ', '.join('{0} = ?'.format(c) for c in columns
+                              if c != 'id'))
+            txn.executemany(query, params)
+        return ids
+
+def _insert_query(tablename, columns):
+    return 'INSERT INTO {0} ({1}) VALUES ({2})'.format(tablename,
+        ', '.join(columns), ', '.join(['?'] * len(columns)))
+
+def _run_blocking(call, *args):
+    '''Runs call (a method of the pool, like _runInteraction) in the pool
+    thread, blocking the calling thread until it is done.
+    Returns (success, result or Failure).'''
+    done = threading.Event()
+    outcome = []
+    def _onResult(success, result):
+        outcome.append((success, result))
+        done.set()
+    Registry.DBPOOL.threadpool.callInThreadWithCallback(_onResult, call,
+                                                        *args)
+    done.wait()
+    return outcome[0]
+
+write_behind = WriteBehindQueue()
+'''The write-behind queue of persistent objects, configured at startup'''
+
+
+class Base(DBObject):
+    '''
+    Base class of persistent objects. Saves go through the write-behind
+    queue, so bulk changes are committed in a few transactions. Twistar's
+    validation and the beforeSave, beforeCreate and beforeUpdate hooks run
+    when save() is called, before the object is queued; a hook returning
+    False or a failed validation stops the save, as in Twistar.
+    '''
+
+    def save(self):
+        def _cbValid(valid):
+            if not valid:
+                return self
+            return defer.maybeDeferred(self.beforeSave).addCallback(
+                _cbBeforeSave)
+        def _cbBeforeSave(result):
+            if result is False:
+                return self
+            if self.id is None and not write_behind.creating(self):
+                hook = self.beforeCreate
+            else:
+                hook = self.beforeUpdate
+            return defer.maybeDeferred(hook).addCallback(_cbBefore)
+        def _cbBefore(result):
+            if result is False:
+                return self
+            return write_behind.save(self)
+        return self.isValid().addCallback(_cbValid)
+
+def create_pool(url=None):
+    '''Creates a connection pool for the database url (configured
+    db-url by default).'''
+    parsed_url = urlparse(url or _config['db-url'])
     driver, args = _drivers[parsed_url.scheme](parsed_url)
-    Registry.DBPOOL = adbapi.ConnectionPool(driver, **args)
-    InteractionBase.LOG = True
+    pool_class = args.pop('pool-class', adbapi.ConnectionPool)
+    _log.info('Opening database {0}'.format(parsed_url.geturl()))
+    return pool_class(driver, **args)
+
+def _on_startup():
+    write_behind.configure(_config)
+    Registry.DBPOOL = create_pool()
+    InteractionBase.LOG = _config['log-queries']
+    if _checkpointer is not None:
+        _checkpointer.start()
     ready()
 
+def _on_shutdown():
+    if Registry.DBPOOL is not None:
+        write_behind.flush_sync()
+        if _checkpointer is not None:
+            _checkpointer.stop()
+            _checkpointer.checkpoint_sync()
+
+def _on_reload(changes):
+    pool = Registry.DBPOOL
+    if 'db-url' in changes:
+        _log.warning('Changed db-url takes effect after a restart')
+    write_behind.configure(_config)
+    InteractionBase.LOG = _config['log-queries']
+    if pool is None:
+        return
+    if isinstance(pool, SQLitePool):
+        if 'pool-size' in changes:
+            pool.max = _config['pool-size']
+            pool.threadpool.adjustPoolsize(pool.min, pool.max)
+        if any(key in changes for key in ('journal-mode', 'synchronous',
+                                          'cache-size', 'mmap-size')):
+            pool.reprofile()
+    if _checkpointer is not None and 'checkpoint-interval' in changes:
+        _checkpointer.stop()
+        _checkpointer.interval = _config['checkpoint-interval']
+        _checkpointer.start()
+
 app.startup.connect(_on_startup)
+app.shutdown.connect(_on_shutdown)
+configuration.register_reload_handler(_on_reload, 'server-persistence')
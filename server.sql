@@ -9,3 +9,8 @@ CREATE TABLE terminals (
     workstation_id INTEGER,
     FOREIGN KEY(workstation_id) REFERENCES workstations(id)
 );
+
+CREATE TABLE id_blocks (
+    tablename TEXT PRIMARY KEY,
+    next_id INTEGER NOT NULL
+);